@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 """Flask web application for Retext SMS Search."""
 
-import html
+import base64
+import json
 import logging
 import os
 import re
 import signal
 import sys
-from datetime import datetime
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime, timedelta
 from functools import wraps
 
 from flask import (
@@ -24,6 +30,7 @@ from werkzeug.security import check_password_hash
 from werkzeug.wrappers import Response
 
 import db
+import import_sms
 
 # T049a: Configure authentication logging
 logging.basicConfig(
@@ -58,6 +65,119 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Strict'
 # Password hash from environment
 PASSWORD_HASH = os.environ.get('PASSWORD_HASH', '')
 
+# Uploaded backups are read from the request in pieces of this size
+UPLOAD_CHUNK = 64 * 1024
+
+# Seconds between import_jobs polls, and between keep-alives on an idle
+# event stream (see api_import_events)
+IMPORT_EVENTS_INTERVAL = 0.5
+IMPORT_EVENTS_KEEPALIVE = 15
+
+# Search totals: 'capped' counts up to SEARCH_COUNT_CAP matches and
+# reports "10,000+" beyond that, 'exact' counts them all, 'none' skips it
+SEARCH_COUNT_MODES = ('capped', 'exact', 'none')
+SEARCH_COUNT_CAP = 10_000
+
+# Matches are wrapped in these by FTS5 highlight() and snippet(), and
+# snippet() marks cut text with the ellipsis; render_highlights() turns
+# them into HTML
+HIGHLIGHT_OPEN = '\x02'
+HIGHLIGHT_CLOSE = '\x03'
+SNIPPET_ELLIPSIS = '\x04'
+HIGHLIGHT_HTML = str.maketrans({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;',
+    HIGHLIGHT_OPEN: '<mark>', HIGHLIGHT_CLOSE: '</mark>', SNIPPET_ELLIPSIS: '\u2026',
+})
+
+# The largest window FTS5 snippet() supports
+SNIPPET_MAX_TOKENS = 64
+
+# sort=date is newest first; relevance is FTS5 bm25, best first; hybrid
+# is bm25 boosted by up to 1 + RECENCY_BOOST for the newest messages. The
+# boost is half that RECENCY_HALF_LIFE seconds older, a third at twice
+# that age, and so on.
+SEARCH_SORTS = ('date', 'relevance', 'hybrid')
+RECENCY_BOOST = 1.0
+RECENCY_HALF_LIFE = 30 * 24 * 3600
+
+# Searches count up to SEARCH_PLAN_SAMPLE of the messages the filters select
+# and of the matches to pick a plan (see prefer_index)
+SEARCH_PLAN_SAMPLE = 1000
+
+# Search responses kept by search_cache
+SEARCH_CACHE_SIZE = 256
+
+# /api/suggest completes words of at least SUGGEST_MIN_PREFIX characters,
+# the shortest prefix messages_fts indexes
+SUGGEST_MIN_PREFIX = 2
+SUGGEST_TERMS = 5
+SUGGEST_MESSAGES = 3
+SUGGEST_SNIPPET_TOKENS = 8
+# complete_term looks for a stem's written form in up to SUGGEST_FORM_SAMPLE
+# of the newest messages containing it
+SUGGEST_FORM_SAMPLE = 20
+
+# /api/conversation returns up to CONVERSATION_MAX messages on each side of
+# its anchor, CONVERSATION_DEFAULT unless asked
+CONVERSATION_DEFAULT = 25
+CONVERSATION_MAX = 100
+
+# One import at a time: SQLite has a single writer, and bulk loads suspend
+# the FTS triggers for the whole database
+import_lock = threading.Lock()
+
+
+class SearchCache:
+    """
+    Thread-safe LRU cache of /api/search responses.
+
+    Entries belong to the db.data_generation() they were computed in. The
+    first lookup in a new generation drops them all, so results are never
+    stale after an import commits.
+    """
+
+    def __init__(self, size=SEARCH_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        """Return the cached response for `key`, or None."""
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, generation, value):
+        """Store a response computed in `generation`, evicting the oldest."""
+        with self.lock:
+            # A newer generation arrived while this response was computed
+            if generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'size': self.size}
+
+
+search_cache = SearchCache()
+suggest_cache = SearchCache()
+
 
 # T046: Security headers middleware
 @app.after_request
@@ -127,16 +247,16 @@ def index():
 @login_required
 def api_stats():
     """Return database statistics."""
-    conn = db.get_connection()
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT COUNT(*) as count FROM messages')
-    count = cursor.fetchone()['count']
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) as count FROM messages')
+        count = cursor.fetchone()['count']
 
     return jsonify({
         'message_count': count,
-        'has_messages': count > 0
+        'has_messages': count > 0,
+        'search_cache': search_cache.stats(),
+        'suggest_cache': suggest_cache.stats(),
     })
 
 
@@ -147,85 +267,522 @@ def api_search():
     """Search messages with FTS5 MATCH query."""
     query = request.args.get('q', '').strip()
     page = request.args.get('page', '1')
+    cursor_arg = request.args.get('cursor')
+    count_mode = request.args.get('count', 'capped')
+    snippet = request.args.get('snippet')
+    sort = request.args.get('sort', 'date')
 
     # Validate query
     if not query:
         return jsonify({'error': 'Missing search query'}), 400
 
-    # Validate page number
-    try:
-        page = max(1, int(page))
-    except ValueError:
-        page = 1
+    if count_mode not in SEARCH_COUNT_MODES:
+        return jsonify({'error': f'count must be one of: {", ".join(SEARCH_COUNT_MODES)}'}), 400
+
+    if sort not in SEARCH_SORTS:
+        return jsonify({'error': f'sort must be one of: {", ".join(SEARCH_SORTS)}'}), 400
+
+    # snippet=N returns about N tokens around the matches instead of the
+    # whole body; /api/messages/<id> has the rest
+    if snippet is not None:
+        try:
+            snippet = int(snippet)
+        except ValueError:
+            snippet = 0
+        if not 1 <= snippet <= SNIPPET_MAX_TOKENS:
+            return jsonify({'error': f'snippet must be between 1 and {SNIPPET_MAX_TOKENS}'}), 400
+
+    # A cursor from a previous response seeks straight to the next page;
+    # page= is still accepted for older clients
+    after = carried = None
+    if cursor_arg:
+        decoded = decode_cursor(cursor_arg)
+        if decoded is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        after, carried = decoded
+        page = None
+    else:
+        # Validate page number
+        try:
+            page = max(1, int(page))
+        except ValueError:
+            page = 1
 
     # T029: Pagination (50 per page)
     per_page = 50
-    offset = (page - 1) * per_page
 
-    conn = db.get_connection()
-    cursor = conn.cursor()
+    try:
+        filters, index = search_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     # Sanitize query for FTS5 (escape special characters)
     safe_query = sanitize_fts_query(query)
 
+    # The tokenizer ignores case and spacing, so neither splits the cache
+    cache_key = (' '.join(query.lower().split()), sort, count_mode, snippet, cursor_arg, page,
+                 tuple(filters))
+
     try:
-        # Get total count
-        cursor.execute('''
-            SELECT COUNT(*) as count
-            FROM messages m
-            JOIN messages_fts fts ON m.id = fts.rowid
-            WHERE messages_fts MATCH ?
-        ''', (safe_query,))
-        total = cursor.fetchone()['count']
+        generation = db.data_generation()
+        cached = search_cache.get(cache_key, generation)
+        if cached is not None:
+            return jsonify(cached)
+
+        with db.connection() as conn:
+            cursor = conn.cursor()
+
+            # Walk the filters' index when that reads fewer messages than
+            # joining the matches. Without filters the matches are joined:
+            # the walk would start from the newest message however old
+            # the matches are.
+            wanted = per_page * (page or 1) if sort == 'date' else None
+            if not filters or not prefer_index(cursor, safe_query, filters, index, wanted):
+                index = None
+
+            # The first page counts the matches; later pages reuse the
+            # total carried in their cursor
+            if carried is not None and (carried[1] or count_mode != 'exact'):
+                total, total_exact = carried
+            else:
+                total, total_exact = count_matches(cursor, safe_query, count_mode,
+                                                   filters, index)
+
+            # Pick one page, plus one row to tell whether another follows
+            offset = 0 if page is None else (page - 1) * per_page
+            page_sql, page_params, order = search_page_query(
+                sort, safe_query, after, per_page + 1, offset, filters, index)
+
+            if snippet:
+                body_sql = 'snippet(messages_fts, 0, ?, ?, ?, ?)'
+                body_params = (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, SNIPPET_ELLIPSIS, snippet)
+            else:
+                body_sql = 'highlight(messages_fts, 0, ?, ?)'
+                body_params = (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE)
+
+            # T030: Highlight only the page's rows. In the same query as
+            # the sort, highlight() would run on every match before the
+            # sorter discards all but a page of them.
+            cursor.execute(f'''
+                SELECT p.id, p.phone_number, p.contact_name, p.timestamp,
+                       p.message_type, p.sort_key, {body_sql} AS body
+                FROM messages_fts
+                JOIN ({page_sql}) p ON messages_fts.rowid = p.id
+                WHERE messages_fts MATCH ?
+                ORDER BY {order}
+            ''', (*body_params, *page_params, safe_query))
+
+            rows = cursor.fetchall()
+
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
 
-        # Get paginated results
-        cursor.execute('''
-            SELECT m.id, m.phone_number, m.contact_name, m.body,
-                   m.timestamp, m.message_type
-            FROM messages m
-            JOIN messages_fts fts ON m.id = fts.rowid
-            WHERE messages_fts MATCH ?
-            ORDER BY m.timestamp DESC
-            LIMIT ? OFFSET ?
-        ''', (safe_query, per_page, offset))
+        # Build results with highlighting and formatting
+        results = [format_message(row, row['body']) for row in rows]
 
-        rows = cursor.fetchall()
-        conn.close()
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor(rows[-1]['sort_key'], rows[-1]['id'],
+                                        total, total_exact)
 
-        # Build results with highlighting and formatting
-        results = []
-        for row in rows:
-            # T30: Highlight search terms
-            highlighted_body = highlight_terms(row['body'], query)
-
-            # T31: Format timestamp
-            formatted_date = format_timestamp(row['timestamp'])
-
-            results.append({
-                'id': row['id'],
-                'phone_number': row['phone_number'],
-                'contact_name': row['contact_name'],
-                'body': highlighted_body,
-                'timestamp': row['timestamp'],
-                'message_type': row['message_type'],
-                'formatted_date': formatted_date
-            })
-
-        has_more = (page * per_page) < total
-
-        return jsonify({
+        response = {
             'results': results,
             'total': total,
-            'page': page,
+            'total_exact': total_exact,
             'per_page': per_page,
-            'has_more': has_more
-        })
+            'has_more': has_more,
+            'next_cursor': next_cursor,
+        }
+        if page is not None:
+            response['page'] = page
+        search_cache.put(cache_key, generation, response)
+        return jsonify(response)
 
     except Exception:
-        conn.close()
         return jsonify({'error': 'Search failed'}), 500
 
 
+# GET /api/suggest: typeahead for the search box
+@app.route('/api/suggest')
+@login_required
+def api_suggest():
+    """
+    Complete the word being typed and preview the newest matches.
+
+    `terms` are the most common indexed words starting with the last word
+    of `q`; `messages` are the most recently imported messages containing
+    the earlier words and a word with that prefix. Both come straight from
+    index lookups, so a keystroke costs a few ms however many messages
+    match.
+    """
+    text = request.args.get('q', '')
+    words = query_tokens(text)
+
+    # Unless the input ends between words, its last word is still a prefix
+    prefix = ''
+    if words and re.search(r'[^\W_]$', text):
+        prefix = words.pop()
+    if len(prefix) < SUGGEST_MIN_PREFIX:
+        prefix = ''
+    if not words and not prefix:
+        return jsonify({'terms': [], 'messages': []})
+
+    cache_key = (tuple(words), prefix)
+    generation = db.data_generation()
+    cached = suggest_cache.get(cache_key, generation)
+    if cached is not None:
+        return jsonify(cached)
+
+    fts_query = ' '.join(f'"{word}"' for word in words)
+    if prefix:
+        fts_query += f' "{prefix}"*'
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        terms = complete_term(cursor, prefix) if prefix else []
+
+        cursor.execute('''
+            SELECT m.id, m.phone_number, m.contact_name, m.timestamp,
+                   m.message_type, snippet(messages_fts, 0, ?, ?, ?, ?) AS body
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+        ''', (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, SNIPPET_ELLIPSIS, SUGGEST_SNIPPET_TOKENS,
+              fts_query, SUGGEST_MESSAGES))
+        messages = [format_message(row, row['body']) for row in cursor.fetchall()]
+
+    response = {'terms': terms, 'messages': messages}
+    suggest_cache.put(cache_key, generation, response)
+    return jsonify(response)
+
+
+def complete_term(cursor, prefix):
+    """
+    Return up to SUGGEST_TERMS words starting with `prefix`, most common first.
+
+    The vocabulary holds porter stems ("happi" for "happy", "run" for
+    "running"), which may run past the prefix or fall short of it. Both
+    kinds are looked up, and each stem is shown as it was written in one
+    of its newest messages, as long as that starts with the prefix.
+    """
+    cursor.execute('''
+        SELECT term, doc FROM messages_vocab
+        WHERE term >= ? AND term < ?
+        ORDER BY doc DESC
+        LIMIT ?
+    ''', (prefix, prefix + '\U0010ffff', SUGGEST_TERMS))
+    stems = cursor.fetchall()
+    # Stems the prefix runs past, allowing for porter's final y to i
+    shorter = []
+    for end in range(SUGGEST_MIN_PREFIX, len(prefix) + 1):
+        if end < len(prefix):
+            shorter.append(prefix[:end])
+        if prefix[end - 1] == 'y':
+            shorter.append(prefix[:end - 1] + 'i')
+    if shorter:
+        cursor.execute(f'''
+            SELECT term, doc FROM messages_vocab
+            WHERE term IN ({', '.join('?' * len(shorter))})
+        ''', shorter)
+        stems = sorted(stems + cursor.fetchall(), key=lambda row: row[1], reverse=True)
+
+    terms = []
+    for stem, _ in stems:
+        cursor.execute('''
+            SELECT highlight(messages_fts, 0, ?, ?) FROM messages_fts
+            WHERE messages_fts MATCH ?
+            ORDER BY rowid DESC
+            LIMIT ?
+        ''', (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, f'"{stem}"', SUGGEST_FORM_SAMPLE))
+        forms = (match.lower() for row in cursor.fetchall()
+                 for match in re.findall(f'{HIGHLIGHT_OPEN}(.*?){HIGHLIGHT_CLOSE}', row[0]))
+        term = next((form for form in forms
+                     if ''.join(query_tokens(form)).startswith(prefix)), None)
+        if term and term not in terms:
+            terms.append(term)
+    return terms[:SUGGEST_TERMS]
+
+
+# GET /api/messages/<id>: one whole message, e.g. to expand a snippet
+@app.route('/api/messages/<int:message_id>')
+@login_required
+def api_message(message_id):
+    """Return one message, with the terms of `q` highlighted if given."""
+    query = request.args.get('q', '').strip()
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, phone_number, contact_name, body, timestamp, message_type
+            FROM messages
+            WHERE id = ?
+        ''', (message_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return jsonify({'error': 'Message not found'}), 404
+
+        body = row['body']
+        if query:
+            cursor.execute('''
+                SELECT highlight(messages_fts, 0, ?, ?)
+                FROM messages_fts
+                WHERE messages_fts MATCH ? AND rowid = ?
+            ''', (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, sanitize_fts_query(query), message_id))
+            highlighted = cursor.fetchone()
+            if highlighted is not None:
+                body = highlighted[0]
+
+    return jsonify(format_message(row, body))
+
+
+# GET /api/conversation/<phone>: the thread around a search hit
+@app.route('/api/conversation/<phone>')
+@login_required
+def api_conversation(phone):
+    """
+    Return the messages of one conversation, oldest first: the `around`
+    message with up to `before` older and `after` newer ones. Without
+    `around`, the newest `before` messages.
+
+    The anchor is included, so a client scrolling on from its first or
+    last message drops the repeat.
+    """
+    around = request.args.get('around')
+    counts = {}
+    for name in ('before', 'after'):
+        try:
+            counts[name] = int(request.args.get(name, CONVERSATION_DEFAULT))
+        except ValueError:
+            counts[name] = -1
+        if not 0 <= counts[name] <= CONVERSATION_MAX:
+            return jsonify({'error': f'{name} must be between 0 and {CONVERSATION_MAX}'}), 400
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        anchor = None
+        if around is not None:
+            try:
+                around = int(around)
+            except ValueError:
+                return jsonify({'error': 'around must be a message id'}), 400
+            cursor.execute('''
+                SELECT id, phone_number, contact_name, body, timestamp, message_type
+                FROM messages
+                WHERE id = ? AND phone_number = ?
+            ''', (around, phone))
+            anchor = cursor.fetchone()
+            if anchor is None:
+                return jsonify({'error': 'Message not found'}), 404
+
+        older = conversation_rows(cursor, phone, anchor, counts['before'] + 1, newer=False)
+        newer = []
+        if anchor is not None:
+            newer = conversation_rows(cursor, phone, anchor, counts['after'] + 1, newer=True)
+
+    # The extra row fetched on each side tells whether more follow
+    rows = older[:counts['before']][::-1] + ([anchor] if anchor else []) + newer[:counts['after']]
+    return jsonify({
+        'phone_number': phone,
+        'messages': [format_message(row, row['body']) for row in rows],
+        'has_before': len(older) > counts['before'],
+        'has_after': len(newer) > counts['after'],
+    })
+
+
+def conversation_rows(cursor, phone, anchor, limit, newer):
+    """
+    Fetch up to `limit` messages of a conversation next to `anchor`, a
+    row, nearest first; from the newest end if anchor is None.
+
+    Seeks idx_messages_phone_timestamp, whose rows are in (timestamp, id)
+    order within a number, so the cost does not grow with the thread.
+    """
+    order = 'ASC' if newer else 'DESC'
+    seek = ''
+    params = [phone]
+    if anchor is not None:
+        seek = f'AND (timestamp, id) {">" if newer else "<"} (?, ?)'
+        params += [anchor['timestamp'], anchor['id']]
+    cursor.execute(f'''
+        SELECT id, phone_number, contact_name, body, timestamp, message_type
+        FROM messages INDEXED BY idx_messages_phone_timestamp
+        WHERE phone_number = ? {seek}
+        ORDER BY timestamp {order}, id {order}
+        LIMIT ?
+    ''', (*params, limit))
+    return cursor.fetchall()
+
+
+# POST /api/imports: upload a backup and import it in the background
+@app.route('/api/imports', methods=['POST'])
+@login_required
+def api_import_upload():
+    """
+    Import a backup sent as the raw request body.
+
+    The body is handed to the importer as it arrives through a bounded
+    queue, so the upload is never buffered in full; a compressed body is
+    decompressed on the fly. The import runs on a background thread and
+    the response (202) is sent once the upload has been read. Progress is
+    available from /api/imports/<id>/events.
+    """
+    if request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        return jsonify({'error': 'Send the backup file as the request body'}), 415
+
+    file_name = request.args.get('name', '').strip() or 'upload'
+    source = request.args.get('source', '').strip() or None
+
+    if not import_lock.acquire(blocking=False):
+        return jsonify({'error': 'An import is already running'}), 409
+
+    reader = import_sms.QueueReader()
+    try:
+        conn = db.get_connection()
+        job_id = import_sms.start_job(conn, file_name, source)
+        conn.close()
+        worker = threading.Thread(target=run_import, args=(reader, job_id, source),
+                                  name=f'import-{job_id}', daemon=True)
+        worker.start()
+    except Exception:
+        import_lock.release()
+        raise
+
+    received = 0
+    try:
+        while True:
+            data = request.stream.read(UPLOAD_CHUNK)
+            if not data:
+                break
+            received += len(data)
+            # False once the importer stopped reading, e.g. on bad XML
+            if not reader.feed(data):
+                break
+    except Exception:
+        reader.fail(ValueError('Upload interrupted'))
+        logger.warning(f'IMPORT_UPLOAD_FAILED job={job_id}')
+        return jsonify({'error': 'Upload interrupted'}), 400
+    reader.finish()
+
+    job = load_job(job_id)
+    job['bytes_received'] = received
+    job['events_url'] = url_for('api_import_events', job_id=job_id)
+    return jsonify(job), 202
+
+
+def run_import(reader, job_id, source):
+    """Background worker for api_import_upload."""
+    try:
+        imported, duplicates, error = import_sms.import_xml(
+            reader, backup_source=source, job_id=job_id, quiet=True)
+        if error:
+            # T049b: the error may quote message content; it stays in import_jobs
+            logger.warning(f'IMPORT_FAILED job={job_id}')
+        else:
+            logger.info(f'IMPORT_DONE job={job_id} imported={imported} duplicates={duplicates}')
+    except Exception as e:
+        # import_xml records its own failures; this catches one that could
+        # not, so the job's event stream still ends
+        logger.exception(f'IMPORT_FAILED job={job_id}')
+        try:
+            with closing(db.get_connection()) as conn:
+                import_sms.finish_job(conn, job_id, 'failed', None, None, None, str(e))
+        except Exception:
+            logger.exception(f'IMPORT_FAILED job={job_id}: could not record the failure')
+    finally:
+        reader.close()
+        import_lock.release()
+
+
+def load_job(job_id):
+    """Return an import_jobs row as a dict, or None."""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, file_name, source, status, total_messages, processed_messages,
+                   started_at, completed_at, error_message
+            FROM import_jobs WHERE id = ?
+        ''', (job_id,))
+        row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+# GET /api/imports: recent imports, from the web app or the CLI
+@app.route('/api/imports')
+@login_required
+def api_imports():
+    """List the 20 most recent imports, newest first."""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, file_name, source, status, total_messages, processed_messages,
+                   started_at, completed_at, error_message
+            FROM import_jobs ORDER BY id DESC LIMIT 20
+        ''')
+        jobs = [dict(row) for row in cursor.fetchall()]
+    return jsonify({'imports': jobs})
+
+
+@app.route('/api/imports/<int:job_id>')
+@login_required
+def api_import(job_id):
+    """Return the current state of one import."""
+    job = load_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(job)
+
+
+# GET /api/imports/<id>/events: progress as Server-Sent Events
+@app.route('/api/imports/<int:job_id>/events')
+@login_required
+def api_import_events(job_id):
+    """
+    Stream an import's progress from import_jobs as Server-Sent Events.
+
+    Sends a `progress` event whenever the job row changes (the importer
+    checkpoints after every batch) and a final `done` event once it has
+    completed or failed, then closes the stream.
+    """
+    if load_job(job_id) is None:
+        return jsonify({'error': 'Import not found'}), 404
+
+    def events():
+        last = None
+        idle = 0.0
+        while True:
+            job = load_job(job_id)
+            if job is None or job['status'] != 'running':
+                yield f'event: done\ndata: {json.dumps(job)}\n\n'
+                return
+            if job != last:
+                yield f'event: progress\ndata: {json.dumps(job)}\n\n'
+                last = job
+                idle = 0.0
+            elif idle >= IMPORT_EVENTS_KEEPALIVE:
+                yield ': keep-alive\n\n'
+                idle = 0.0
+            time.sleep(IMPORT_EVENTS_INTERVAL)
+            idle += IMPORT_EVENTS_INTERVAL
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def query_tokens(text):
+    """
+    Split text into words roughly as the unicode61 tokenizer does:
+    lowercased runs of letters and digits, with diacritics removed.
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return re.findall(r'[^\W_]+', text)
+
+
 def sanitize_fts_query(query):
     """Sanitize search query for FTS5."""
     # Escape FTS5 special characters
@@ -234,22 +791,293 @@ def sanitize_fts_query(query):
     return f'"{escaped}"'
 
 
-def highlight_terms(body, query):
-    """T030: Highlight search terms with <mark> tags."""
-    # HTML escape the body first
-    safe_body = html.escape(body)
-
-    # Split query into words and highlight each
-    words = query.split()
-    for word in words:
-        # Case-insensitive highlight
-        pattern = re.compile(re.escape(word), re.IGNORECASE)
-        safe_body = pattern.sub(
-            lambda m: f'<mark>{html.escape(m.group())}</mark>',
-            safe_body
+def search_filters(args):
+    """
+    Read the phone, from, to and type filters of a search request.
+
+    Returns (filters, index): a list of (condition, value) pairs on
+    messages m, and the index that finds the filtered messages newest first.
+    from and to are local dates, both included. Raises ValueError with a
+    message for the client if a filter is malformed.
+    """
+    filters = []
+    phone = args.get('phone', '').strip()
+    if phone:
+        # As stored by the importer, which keeps the backup's formatting
+        filters.append(('m.phone_number = ?', phone))
+
+    for name, condition, days in (('from', 'm.timestamp >= ?', 0), ('to', 'm.timestamp < ?', 1)):
+        value = args.get(name)
+        if value:
+            # Dates at the ends of the calendar have no timestamp
+            try:
+                day = datetime.strptime(value, '%Y-%m-%d') + timedelta(days=days)
+                timestamp = int(day.timestamp() * 1000)
+            except (ValueError, OverflowError, OSError):
+                raise ValueError(f'{name} must be a date as YYYY-MM-DD') from None
+            filters.append((condition, timestamp))
+
+    message_type = args.get('type')
+    if message_type:
+        try:
+            message_type = int(message_type)
+        except ValueError:
+            message_type = None
+        # SQLite integers are 64-bit
+        if message_type is None or not -2**63 <= message_type < 2**63:
+            raise ValueError('type must be a message type: 1 received, 2 sent')
+        filters.append(('m.message_type = ?', message_type))
+
+    if phone:
+        index = 'idx_messages_phone_timestamp'
+    elif message_type:
+        index = 'idx_messages_type_timestamp'
+    else:
+        index = 'idx_messages_timestamp'
+    return filters, index
+
+
+def prefer_index(cursor, safe_query, filters, index, wanted=None):
+    """
+    Whether to find matches by walking the filters' index rather than
+    joining every match to its message.
+
+    `wanted` is how many matches a date-sorted page reads, or None when a
+    ranked sort reads them all. Counts each side up to SEARCH_PLAN_SAMPLE,
+    and when both reach it weighs the join's one message per match against
+    the walk's wanted * selected / matches, taking that ratio from the
+    newest selected messages, where the walk starts.
+    """
+    where = ' AND '.join(condition for condition, _ in filters)
+    filter_values = tuple(value for _, value in filters)
+    count_selected = f'''
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM messages m INDEXED BY {index} WHERE {where} LIMIT ?
         )
-
-    return safe_body
+    '''
+    cursor.execute(count_selected, (*filter_values, SEARCH_PLAN_SAMPLE))
+    selected = cursor.fetchone()[0]
+    cursor.execute('''
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?
+        )
+    ''', (safe_query, SEARCH_PLAN_SAMPLE))
+    matches = cursor.fetchone()[0]
+    if min(selected, matches) < SEARCH_PLAN_SAMPLE:
+        return selected <= matches
+
+    # Counting the matches exactly is cheap; the selected messages are
+    # not, so a ranked sort counts them only as far as the matches
+    cursor.execute('''
+        SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?
+    ''', (safe_query,))
+    matches = cursor.fetchone()[0]
+    if wanted is None:
+        cursor.execute(count_selected, (*filter_values, matches + 1))
+        return cursor.fetchone()[0] <= matches
+
+    cursor.execute(f'''
+        SELECT COUNT(*) FROM (
+            SELECT m.id FROM messages m INDEXED BY {index} WHERE {where}
+            ORDER BY m.timestamp DESC, m.id DESC LIMIT ?
+        )
+        WHERE +id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)
+    ''', (*filter_values, SEARCH_PLAN_SAMPLE, safe_query))
+    return wanted * SEARCH_PLAN_SAMPLE <= cursor.fetchone()[0] * matches
+
+
+def filtered_matches(filters, index=None):
+    """
+    Build the FROM and WHERE clauses for the messages m that match an FTS
+    query and the filters.
+
+    Takes the query, then the filters' values. With `index`, walks it and
+    keeps the rows in the match set, which is gathered once. Otherwise each
+    match is joined to its message. The unary + and CROSS JOIN pin these
+    plans: left to choose, SQLite runs the FTS query again for every
+    message the filters select.
+    """
+    where = ''.join(f' AND {condition}' for condition, _ in filters)
+    if index:
+        return (f'FROM messages m INDEXED BY {index} '
+                f'WHERE +m.id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?){where}')
+    return ('FROM messages_fts fts CROSS JOIN messages m ON m.id = fts.rowid '
+            f'WHERE messages_fts MATCH ?{where}')
+
+
+def search_page_query(sort, safe_query, after, limit, offset, filters=(), index=None):
+    """
+    Build the query for one page of matches in `sort` order.
+
+    Returns (sql, params, order). Rows carry sort_key, which a cursor
+    resumes from via `after`, and ties on it are broken by id. `order` is
+    the ORDER BY for an outer query over the rows, aliased p. `filters`
+    and `index` are as from search_filters(), with index None when the
+    matches are the fewer (see prefer_index).
+    """
+    filter_values = tuple(value for _, value in filters)
+
+    if sort == 'date':
+        seek = 'AND (m.timestamp, m.id) < (?, ?)' if after else ''
+        sql = f'''
+            SELECT m.id, m.phone_number, m.contact_name, m.timestamp,
+                   m.message_type, m.timestamp AS sort_key
+            {filtered_matches(filters, index)} {seek}
+            ORDER BY m.timestamp DESC, m.id DESC
+            LIMIT ? OFFSET ?
+        '''
+        params = (safe_query, *filter_values, *(after or ()), limit, offset)
+        return sql, params, 'p.sort_key DESC, p.id DESC'
+
+    if sort == 'relevance' and filters and not index:
+        # Few matches: join them all to test the filters, and take the
+        # page straight from the join
+        seek = 'AND (fts.rank, fts.rowid) > (?, ?)' if after else ''
+        sql = f'''
+            SELECT m.id, m.phone_number, m.contact_name, m.timestamp,
+                   m.message_type, fts.rank AS sort_key
+            {filtered_matches(filters)} {seek}
+            ORDER BY fts.rank, fts.rowid
+            LIMIT ? OFFSET ?
+        '''
+        params = (safe_query, *filter_values, *(after or ()), limit, offset)
+        return sql, params, 'p.sort_key, p.id'
+
+    if sort == 'relevance':
+        # bm25 is computed from the index alone; messages are only joined
+        # for the page's rows. LIMIT -1 keeps SQLite from flattening this
+        # into the caller's query, which would join every match instead.
+        # Filters are gathered from their index once, as in
+        # filtered_matches().
+        restrict = ''
+        if filters:
+            where = ' AND '.join(condition for condition, _ in filters)
+            restrict = f'AND +rowid IN (SELECT m.id FROM messages m INDEXED BY {index} WHERE {where})'
+        seek = 'AND (rank, rowid) > (?, ?)' if after else ''
+        sql = f'''
+            SELECT m.id, m.phone_number, m.contact_name, m.timestamp,
+                   m.message_type, r.rank AS sort_key
+            FROM (
+                SELECT rowid, rank FROM messages_fts
+                WHERE messages_fts MATCH ? {restrict} {seek}
+                ORDER BY rank, rowid
+                LIMIT ? OFFSET ?
+            ) r
+            JOIN messages m ON m.id = r.rowid
+            ORDER BY r.rank, r.rowid
+            LIMIT -1
+        '''
+        params = (safe_query, *filter_values, *(after or ()), limit, offset)
+        return sql, params, 'p.sort_key, p.id'
+
+    # hybrid: rank is negative, best first, so scaling it up promotes a
+    # message. Age is measured from the newest message rather than now, so
+    # an old archive still has a recent end.
+    seek = 'WHERE (sort_key, id) > (?, ?)' if after else ''
+    sql = f'''
+        SELECT * FROM (
+            SELECT m.id, m.phone_number, m.contact_name, m.timestamp,
+                   m.message_type,
+                   fts.rank * (1 + ? * ? / (? + (SELECT MAX(timestamp) FROM messages)
+                                               - m.timestamp)) AS sort_key
+            {filtered_matches(filters)}
+        ) {seek}
+        ORDER BY sort_key, id
+        LIMIT ? OFFSET ?
+    '''
+    half_life_ms = float(RECENCY_HALF_LIFE * 1000)
+    params = (RECENCY_BOOST, half_life_ms, half_life_ms, safe_query, *filter_values,
+              *(after or ()), limit, offset)
+    return sql, params, 'p.sort_key, p.id'
+
+
+def count_matches(cursor, safe_query, mode, filters=(), index=None):
+    """
+    Count the messages matching an FTS query, per SEARCH_COUNT_MODES.
+
+    Returns (total, exact). Without filters, counts the index alone: the
+    sync triggers keep every messages_fts row backed by a message, and
+    skipping the join makes the count many times cheaper. With them, the
+    matches are found as in filtered_matches().
+    """
+    if mode == 'none':
+        return None, False
+    if filters:
+        source = filtered_matches(filters, index)
+        params = (safe_query, *(value for _, value in filters))
+    else:
+        source = 'FROM messages_fts WHERE messages_fts MATCH ?'
+        params = (safe_query,)
+    if mode == 'exact':
+        cursor.execute(f'SELECT COUNT(*) {source}', params)
+        return cursor.fetchone()[0], True
+    cursor.execute(f'SELECT COUNT(*) FROM (SELECT 1 {source} LIMIT ?)',
+                   (*params, SEARCH_COUNT_CAP + 1))
+    total = cursor.fetchone()[0]
+    if total > SEARCH_COUNT_CAP:
+        return SEARCH_COUNT_CAP, False
+    return total, True
+
+
+def encode_cursor(sort_key, message_id, total=None, total_exact=False):
+    """Encode the last row's sort key and the search total as a cursor."""
+    fields = [sort_key, message_id]
+    if total is not None:
+        fields += [total, int(total_exact)]
+    data = json.dumps(fields, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(value):
+    """
+    Return ((sort_key, id), (total, exact)) from a cursor.
+
+    The second item is None if the cursor carries no total. Returns None
+    if the cursor is malformed.
+    """
+    try:
+        data = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+        fields = json.loads(data)
+    except ValueError:
+        return None
+    # The sort key is a timestamp, or a float score for ranked sorts
+    if (not isinstance(fields, list) or len(fields) not in (2, 4)
+            or type(fields[0]) not in (int, float)
+            or not all(type(n) is int for n in fields[1:])):
+        return None
+    if len(fields) == 2:
+        return tuple(fields), None
+    return tuple(fields[:2]), (fields[2], bool(fields[3]))
+
+
+def format_message(row, body):
+    """
+    Build the JSON for one message from its row and its highlight(),
+    snippet() or plain body.
+    """
+    return {
+        'id': row['id'],
+        'phone_number': row['phone_number'],
+        'contact_name': row['contact_name'],
+        # T30: Highlight search terms
+        'body': render_highlights(body),
+        'truncated': SNIPPET_ELLIPSIS in body,
+        'timestamp': row['timestamp'],
+        'message_type': row['message_type'],
+        # T31: Format timestamp
+        'formatted_date': format_timestamp(row['timestamp']),
+    }
+
+
+def render_highlights(text):
+    """
+    T030: Turn highlight() output into HTML.
+
+    Escapes the text and replaces the marker characters with <mark> tags
+    and an ellipsis in a single pass. The markers cannot occur in imported
+    bodies: XML 1.0 does not allow them, even as character references.
+    """
+    return text.translate(HIGHLIGHT_HTML)
 
 
 def format_timestamp(timestamp_ms):
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""Synthetic backups and import throughput benchmarks for Retext."""
+
+import argparse
+import base64
+import gzip
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from contextlib import redirect_stdout
+from xml.sax.saxutils import escape
+
+import db
+import import_sms
+
+# Body lengths follow a log-normal distribution, like real texts: mostly
+# short, with a long tail of pasted paragraphs
+DEFAULT_BODY_MEDIAN = 35
+DEFAULT_BODY_SIGMA = 0.9
+DEFAULT_BODY_MAX = 1600
+
+# Repeated messages are drawn from this many recently written ones, the way
+# overlapping backups repeat their most recent history
+DUPLICATE_WINDOW = 10_000
+
+# Allowed slowdown or growth against a baseline before `run` fails
+DEFAULT_TOLERANCE = 0.10
+
+WORDS = (
+    'the you to and i a it is that on for be at with have this are not but '
+    'can what so do we just if me my your get go all know was will was up '
+    'out like one time now about then there see how good when yeah ok lol '
+    'home work dinner tonight tomorrow today call later love thanks sure '
+    'meet running late soon morning night coffee weekend movie car store '
+    'need sounds great happy birthday leaving picking kids school game '
+    'pizza traffic flight landed parking weather rain sorry miss haha omg '
+    'address number meeting doctor appointment grocery list milk eggs bread'
+).split()
+
+# Mixed in now and then so the importer sees escaping and non-ASCII text
+EXTRAS = ('&', '<3', '"quoted"', "it's", 'café', '\U0001F602', '\n', '!!', '?', '...')
+
+FIRST_NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Casey', 'Riley', 'Morgan',
+               'Jamie', 'Avery', 'Quinn', 'Mom', 'Dad', 'Grandma', 'Work')
+
+
+def generate_body(rng, median, sigma, max_length):
+    """Return a message body with a log-normally distributed length."""
+    length = min(max(1, int(rng.lognormvariate(math.log(median), sigma))), max_length)
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(EXTRAS) if rng.random() < 0.05 else rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length].strip() or 'ok'
+
+
+def sms_element(address, contact_name, body, date, message_type):
+    """Format one <sms> element the way SMS Backup & Restore writes it."""
+    body = escape(body, {'"': '&quot;', '\n': '&#10;'})
+    readable = time.strftime('%b %d, %Y %I:%M:%S %p', time.gmtime(date / 1000))
+    return (
+        f'  <sms protocol="0" address="{address}" date="{date}" type="{message_type}" '
+        f'subject="null" body="{body}" toa="null" sc_toa="null" service_center="null" '
+        f'read="1" status="-1" locked="0" date_sent="{date - 1000}" sub_id="1" '
+        f'readable_date="{readable}" contact_name="{contact_name}" />\n'
+    )
+
+
+def mms_element(data_seed, address, contact_name, body, date, message_type, attachment_kb):
+    """
+    Format one <mms> element with a text part and a JPEG-sized blob of
+    random bytes from `data_seed`.
+    """
+    data = base64.b64encode(random.Random(data_seed).randbytes(attachment_kb * 1024)).decode()
+    body = escape(body, {'"': '&quot;', '\n': '&#10;'})
+    return (
+        f'  <mms date="{date}" msg_box="{message_type}" address="{address}" '
+        f'contact_name="{contact_name}" m_type="{128 if message_type == 2 else 132}" '
+        f'ct_t="application/vnd.wap.multipart.related" read="1">\n'
+        f'    <parts>\n'
+        f'      <part seq="-1" ct="application/smil" name="null" cl="smil.xml" '
+        f'text="&lt;smil&gt;&lt;/smil&gt;" />\n'
+        f'      <part seq="0" ct="text/plain" name="null" cl="text_0.txt" text="{body}" />\n'
+        f'      <part seq="0" ct="image/jpeg" name="IMG_{date}.jpg" cl="IMG_{date}.jpg" '
+        f'data="{data}" />\n'
+        f'    </parts>\n'
+        f'    <addrs><addr address="{address}" type="137" charset="106" /></addrs>\n'
+        f'  </mms>\n'
+    )
+
+
+def generate_backup(path, messages, duplicate_ratio=0.0, contacts=200,
+                    body_median=DEFAULT_BODY_MEDIAN, body_sigma=DEFAULT_BODY_SIGMA,
+                    body_max=DEFAULT_BODY_MAX, mms_ratio=0.0, attachment_kb=50, seed=0):
+    """
+    Write a synthetic SMS Backup & Restore file with `messages` elements.
+
+    A `duplicate_ratio` share of the elements repeats one of the last
+    DUPLICATE_WINDOW messages verbatim. Contacts are picked with a Zipf-like
+    skew, so a few conversations hold most of the messages. Output is
+    written as it is generated (gzip-compressed for a .gz path), so any
+    size can be produced in constant memory. Returns the number of distinct
+    messages written.
+
+    The duplicate window keeps an MMS as its parameters, not its base64
+    attachment, and is only filled when duplicates are asked for.
+    """
+    rng = random.Random(seed)
+    people = [
+        (f'+1555{rng.randrange(10**7):07d}', f'{rng.choice(FIRST_NAMES)} {i}')
+        for i in range(contacts)
+    ]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(contacts)))
+    recent = deque(maxlen=DUPLICATE_WINDOW)
+    date = 1420070400000  # 2015-01-01
+    distinct = 0
+
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as out:
+        out.write("<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
+        out.write(f'<smses count="{messages}" backup_set="benchmark-{seed}" '
+                  f'backup_date="{date}" type="full">\n')
+        for _ in range(messages):
+            if recent and rng.random() < duplicate_ratio:
+                element = rng.choice(recent)
+                out.write(element if isinstance(element, str) else mms_element(*element))
+                continue
+            date += int(rng.expovariate(1 / 600) * 1000) + 1
+            address, contact_name = rng.choices(people, cum_weights=cum_weights)[0]
+            body = generate_body(rng, body_median, body_sigma, body_max)
+            message_type = rng.choice((1, 2))
+            if rng.random() < mms_ratio:
+                params = (rng.getrandbits(64), address, contact_name, body, date,
+                          message_type, attachment_kb)
+                element = mms_element(*params)
+            else:
+                params = element = sms_element(address, contact_name, body, date, message_type)
+            out.write(element)
+            if duplicate_ratio > 0:
+                recent.append(params)
+            distinct += 1
+        out.write('</smses>\n')
+    return distinct
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None if unavailable."""
+    try:
+        # VmHWM starts over at exec; ru_maxrss is inherited across fork
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def database_sizes(db_path):
+    """Return (database bytes, FTS bytes); FTS is None without dbstat."""
+    db_bytes = sum(os.path.getsize(db_path + suffix)
+                   for suffix in ('', '-wal') if os.path.exists(db_path + suffix))
+    conn = sqlite3.connect(db_path)
+    try:
+        fts_bytes = conn.execute(
+            "SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'messages\\_fts%' ESCAPE '\\'"
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB
+        fts_bytes = None
+    finally:
+        conn.close()
+    return db_bytes, fts_bytes
+
+
+def measure_import(backup, data_dir, parser='auto', workers=0, passes=1):
+    """
+    Import `backup` into a database in `data_dir` and return measurements.
+
+    Runs in the process being measured (see run_benchmark). With `passes`
+    > 1 the same file is imported again into the same database, which
+    measures the duplicate path. Importer output goes to stderr.
+    """
+    db.DB_PATH = os.path.join(data_dir, 'messages.db')
+    results = []
+    for number in range(passes):
+        start = time.perf_counter()
+        with redirect_stdout(sys.stderr):
+            imported, duplicates, error = import_sms.import_xml(
+                backup, workers=workers, parser=parser)
+        seconds = time.perf_counter() - start
+        if error:
+            raise RuntimeError(error)
+        messages = imported + duplicates
+        db_bytes, fts_bytes = database_sizes(db.DB_PATH)
+        results.append({
+            'phase': 'import' if number == 0 else 'reimport',
+            'messages': messages,
+            'imported': imported,
+            'duplicates': duplicates,
+            'seconds': round(seconds, 3),
+            'messages_per_second': round(messages / seconds) if seconds else None,
+            'peak_rss_mb': peak_rss_mb(),
+            'db_bytes': db_bytes,
+            'fts_bytes': fts_bytes,
+        })
+    return results
+
+
+def run_benchmark(backup, parser='auto', workers=0, repeat=3, reimport=False):
+    """
+    Benchmark imports of `backup` and return a JSON-serializable report.
+
+    Every repetition imports into a fresh database in a new child process,
+    so peak RSS covers exactly one import. `summary` holds the median of
+    each metric per phase.
+    """
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix='retext-bench-') as data_dir:
+            # The child runs beside this script, so it needs the backup's
+            # absolute path
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'measure', os.path.abspath(backup),
+                 data_dir, '--parser', parser, '--workers', str(workers),
+                 '--passes', '2' if reimport else '1'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            )
+            if child.returncode:
+                print(child.stderr, end='', file=sys.stderr)
+                raise subprocess.CalledProcessError(child.returncode, child.args,
+                                                    child.stdout, child.stderr)
+            runs.extend(json.loads(child.stdout))
+
+    summary = {}
+    for phase in ('import', 'reimport'):
+        phase_runs = [run for run in runs if run['phase'] == phase]
+        if phase_runs:
+            summary[phase] = {
+                key: statistics.median_low(run[key] for run in phase_runs)
+                if phase_runs[0][key] is not None else None
+                for key in phase_runs[0] if key != 'phase'
+            }
+
+    return {
+        'backup': os.path.basename(str(backup)),
+        'backup_bytes': os.path.getsize(backup),
+        'parser': import_sms.choose_parser(parser),
+        'workers': workers,
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'runs': runs,
+        'summary': summary,
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return a list of regressions of `report` against an earlier report.
+
+    Throughput may drop and memory and database size may grow by at most
+    `tolerance` (a fraction) per phase before it counts as a regression.
+    """
+    regressions = []
+    for phase, base in baseline.get('summary', {}).items():
+        current = report['summary'].get(phase)
+        if current is None:
+            continue
+        rate, base_rate = current['messages_per_second'], base.get('messages_per_second')
+        if base_rate and rate < base_rate * (1 - tolerance):
+            regressions.append(f'{phase}: {rate:,.0f} msg/s, was {base_rate:,.0f}')
+        for key in ('peak_rss_mb', 'db_bytes', 'fts_bytes'):
+            value, base_value = current.get(key), base.get(key)
+            if value is not None and base_value and value > base_value * (1 + tolerance):
+                regressions.append(f'{phase}: {key} {value:,.1f}, was {base_value:,.1f}')
+    return regressions
+
+
+def format_summary(report):
+    """Format the per-phase medians of a report for the terminal."""
+    lines = [f"{report['backup']} ({report['parser']}, {report['workers']} workers, "
+             f"median of {report['repeat']})"]
+    for phase, result in report['summary'].items():
+        fts = (f", FTS {result['fts_bytes'] / 2**20:.1f} MB"
+               if result['fts_bytes'] is not None else '')
+        rss = (f", peak RSS {result['peak_rss_mb']:.1f} MB"
+               if result['peak_rss_mb'] is not None else '')
+        lines.append(
+            f"  {phase}: {result['messages']:,.0f} messages in {result['seconds']:.2f}s, "
+            f"{result['messages_per_second']:,.0f} msg/s{rss}, "
+            f"database {result['db_bytes'] / 2**20:.1f} MB{fts}"
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic backups and benchmark Retext imports',
+        epilog='Example: python benchmark.py generate bench.xml --messages 1000000 && '
+               'python benchmark.py run bench.xml --output result.json'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='Write a synthetic backup file')
+    generate.add_argument('output', help='Path to write (.gz to compress)')
+    generate.add_argument('--messages', type=int, default=10_000, metavar='N',
+                          help='Number of messages (default: 10,000)')
+    generate.add_argument('--duplicate-ratio', type=float, default=0.0, metavar='R',
+                          help='Share of messages that repeat an earlier one (0-1)')
+    generate.add_argument('--contacts', type=int, default=200, metavar='N',
+                          help='Number of distinct phone numbers (default: 200)')
+    generate.add_argument('--body-median', type=int, default=DEFAULT_BODY_MEDIAN,
+                          metavar='CHARS', help='Median body length '
+                          f'(default: {DEFAULT_BODY_MEDIAN})')
+    generate.add_argument('--body-sigma', type=float, default=DEFAULT_BODY_SIGMA,
+                          metavar='S', help='Spread of the log-normal body length '
+                          f'(default: {DEFAULT_BODY_SIGMA})')
+    generate.add_argument('--body-max', type=int, default=DEFAULT_BODY_MAX,
+                          metavar='CHARS', help=f'Longest body (default: {DEFAULT_BODY_MAX})')
+    generate.add_argument('--mms-ratio', type=float, default=0.0, metavar='R',
+                          help='Share of messages that are MMS with an attachment (0-1)')
+    generate.add_argument('--attachment-kb', type=int, default=50, metavar='KB',
+                          help='Size of each MMS attachment (default: 50)')
+    generate.add_argument('--seed', type=int, default=0,
+                          help='Random seed; the same seed gives the same file')
+
+    run = commands.add_parser('run', help='Benchmark importing a backup file')
+    run.add_argument('backup', help='Backup file to import')
+    run.add_argument('--parser', choices=['auto', *import_sms.PARSERS], default='auto')
+    run.add_argument('--workers', type=int, default=0, metavar='N')
+    run.add_argument('--repeat', type=int, default=3, metavar='N',
+                     help='Imports to take the median of (default: 3)')
+    run.add_argument('--reimport', action='store_true',
+                     help='Also time importing the same file a second time')
+    run.add_argument('--output', metavar='FILE',
+                     help='Write the JSON report here instead of stdout')
+    run.add_argument('--baseline', metavar='FILE',
+                     help='Earlier JSON report; exit 1 if this run regressed')
+    run.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, metavar='F',
+                     help='Allowed regression as a fraction '
+                          f'(default: {DEFAULT_TOLERANCE})')
+
+    # Internal: one measured import, run by `run` in a child process
+    measure = commands.add_parser('measure')
+    measure.add_argument('backup')
+    measure.add_argument('data_dir')
+    measure.add_argument('--parser', default='auto')
+    measure.add_argument('--workers', type=int, default=0)
+    measure.add_argument('--passes', type=int, default=1)
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        if not 0 <= args.duplicate_ratio < 1 or not 0 <= args.mms_ratio <= 1:
+            parser.error('--duplicate-ratio and --mms-ratio must be between 0 and 1')
+        start = time.time()
+        distinct = generate_backup(
+            args.output, args.messages, args.duplicate_ratio, args.contacts,
+            args.body_median, args.body_sigma, args.body_max,
+            args.mms_ratio, args.attachment_kb, args.seed,
+        )
+        print(f"Wrote {args.messages:,} messages ({distinct:,} distinct) to {args.output} "
+              f"in {time.time() - start:.1f} seconds")
+
+    elif args.command == 'measure':
+        results = measure_import(args.backup, args.data_dir, args.parser,
+                                 args.workers, args.passes)
+        print(json.dumps(results))
+
+    else:
+        report = run_benchmark(args.backup, args.parser, args.workers,
+                               args.repeat, args.reimport)
+        print(format_summary(report), file=sys.stderr)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+            for regression in regressions:
+                print(f"Regression: {regression}", file=sys.stderr)
+            if regressions:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
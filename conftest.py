@@ -29,9 +29,11 @@ def temp_db():
     yield temp_path
 
     # Restore original and cleanup
+    db_module.close_pool()
     db_module.DB_PATH = original_path
-    if os.path.exists(temp_path):
-        os.unlink(temp_path)
+    for path in (temp_path, temp_path + '-wal', temp_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
 
 
 @pytest.fixture
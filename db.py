@@ -1,61 +1,440 @@
 """Database initialization module for Retext SMS Search."""
 
+import itertools
 import os
 import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
 
 # DATA_DIR from environment, default to current directory
 DATA_DIR = os.environ.get('DATA_DIR', '')
 DB_PATH = os.path.join(DATA_DIR, 'messages.db') if DATA_DIR else 'messages.db'
 
+# Set by init_db(). In WAL mode searches keep reading while an import
+# commits; use JOURNAL_MODE=delete where the database lives on a
+# filesystem without shared-memory support, such as a network share.
+JOURNAL_MODE = os.environ.get('JOURNAL_MODE', 'wal').lower()
+JOURNAL_MODES = ('wal', 'delete', 'truncate', 'persist')
+
+# Seconds to wait for a lock. Web reads only wait on WAL recovery or a
+# rollback-journal commit; writers may queue behind a whole import batch.
+READ_TIMEOUT = 5.0
+WRITE_TIMEOUT = 30.0
+
+# Stored in PRAGMA user_version; see migrate()
+SCHEMA_VERSION = 5
+
+# T007: Main messages table. import_hash is a 16-byte binary digest (see
+# import_sms.compute_import_hash); its UNIQUE constraint is the only index
+# needed for deduplication.
+MESSAGES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone_number TEXT NOT NULL,
+        contact_name TEXT,
+        body TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        message_type INTEGER NOT NULL,
+        import_hash BLOB UNIQUE
+    )
+'''
+
+# prefix= adds indexes of every token's first 2 and 3 characters, so the
+# typeahead's prefix queries read one doclist instead of merging those of
+# every term with the prefix
+FTS_TABLE_SQL = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        body,
+        content='messages',
+        content_rowid='id',
+        tokenize='porter unicode61',
+        prefix='2 3'
+    )
+'''
+
+
+# Idle connections kept open by connection(). The web app's statements
+# are few and fixed, so a statement cache of this size never evicts one.
+POOL_SIZE = 8
+CACHED_STATEMENTS = 256
+
+
+def attachments_dir():
+    """Directory of the content-addressed MMS attachment store, next to the database."""
+    return os.path.join(os.path.dirname(DB_PATH), 'attachments')
+
 
 def get_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(DB_PATH)
+    """Get a read-write database connection."""
+    conn = sqlite3.connect(DB_PATH, timeout=WRITE_TIMEOUT)
     conn.row_factory = sqlite3.Row
+    if JOURNAL_MODE == 'wal':
+        # Sync at checkpoints instead of every commit. In WAL mode a crash
+        # can lose the last commits but cannot corrupt the database.
+        conn.execute('PRAGMA synchronous = NORMAL')
     return conn
 
 
+def checkpoint(conn, mode='TRUNCATE'):
+    """
+    Copy committed WAL frames into the database file.
+
+    TRUNCATE also empties the -wal file, which an import can grow to
+    hundreds of MB. Returns False if readers kept the checkpoint from
+    completing. Does nothing outside WAL mode.
+    """
+    if JOURNAL_MODE != 'wal':
+        return True
+    busy, _, _ = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+    return not busy
+
+
+class ConnectionPool:
+    """
+    Thread-safe LIFO pool of read-only connections to one database file.
+
+    Connections are opened with check_same_thread=False and only ever used
+    by one thread at a time, between acquire() and release(). LIFO reuse
+    keeps the most recently used connection, with the warmest page cache,
+    in service.
+    """
+
+    # Numbers pools, so tokens from a replaced pool never match a new one
+    serials = itertools.count()
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.serial = next(self.serials)
+        self.path = path
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        # Answers data_version() for the whole pool; see data_generation()
+        self.watcher = None
+        self.watcher_lock = threading.Lock()
+
+    def open(self):
+        uri = Path(self.path).absolute().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, timeout=READ_TIMEOUT,
+                               check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def acquire(self):
+        """Return a healthy connection, reusing an idle one if possible."""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            try:
+                conn.execute('SELECT 1').fetchone()
+                return conn
+            except sqlite3.Error:
+                # Closed or broken (e.g. the file was replaced); drop it
+                conn.close()
+        return self.open()
+
+    def release(self, conn):
+        """Return a connection to the pool, or close it if the pool is full."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def data_version(self):
+        """
+        Return PRAGMA data_version from the pool's watcher connection.
+
+        The value changes after any other connection commits. It is only
+        comparable between calls on the same connection, so one connection
+        answers for the pool.
+        """
+        with self.watcher_lock:
+            if self.watcher is not None:
+                try:
+                    return self.watcher.execute('PRAGMA data_version').fetchone()[0]
+                except sqlite3.Error:
+                    self.watcher.close()
+            self.watcher = self.open()
+            return self.watcher.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+        with self.watcher_lock:
+            if self.watcher is not None:
+                self.watcher.close()
+                self.watcher = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the pool for the current DB_PATH, replacing a stale one."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+
+def close_pool():
+    """Close all idle pooled connections."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+
+
+def _reset_pool_after_fork():
+    # A child must not use (or close) connections opened by its parent
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
+def data_generation():
+    """
+    Return a token that changes whenever the database's contents change.
+
+    Caches tag results with it; an equal token means nothing has been
+    committed since. Commits from any process count, and so does switching
+    DB_PATH, which replaces the pool.
+    """
+    pool = get_pool()
+    return pool.serial, pool.data_version()
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a pooled read-only connection for the duration of a `with` block.
+
+    For short requests in the web app, which would otherwise pay for
+    opening the file, parsing the schema and a cold page cache every time.
+    Any transaction left open is rolled back when the connection is
+    returned. Writers, such as the importer, use get_connection() instead.
+    """
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
 def init_db():
     """Initialize the database with all required tables and indexes."""
+    if JOURNAL_MODE not in JOURNAL_MODES:
+        raise ValueError(f'JOURNAL_MODE must be one of: {", ".join(JOURNAL_MODES)}')
+
     conn = get_connection()
     cursor = conn.cursor()
 
+    # Stored in the file, so every later connection uses it too
+    cursor.execute(f'PRAGMA journal_mode = {JOURNAL_MODE}')
+
     # T007: Main messages table
+    cursor.execute(MESSAGES_TABLE_SQL.format(name='messages'))
+
+    create_message_indexes(cursor)
+
+    # T008: FTS5 virtual table for full-text search
+    cursor.execute(FTS_TABLE_SQL)
+
+    # One row per indexed term with its document count, for /api/suggest
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_vocab
+        USING fts5vocab(messages_fts, row)
+    ''')
+
+    # T010: Import tracking table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS import_jobs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone_number TEXT NOT NULL,
-            contact_name TEXT,
-            body TEXT NOT NULL,
-            timestamp INTEGER NOT NULL,
-            message_type INTEGER NOT NULL,
-            import_hash TEXT UNIQUE
+            file_name TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            total_messages INTEGER DEFAULT 0,
+            processed_messages INTEGER DEFAULT 0,
+            started_at INTEGER NOT NULL,
+            completed_at INTEGER,
+            error_message TEXT,
+            source TEXT,
+            max_timestamp INTEGER,
+            byte_offset INTEGER
+        )
+    ''')
+
+    # MMS attachments. The bytes live in attachments_dir() under their
+    # sha256; rows only point at them, in part order within the message.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            message_id INTEGER NOT NULL REFERENCES messages(id),
+            position INTEGER NOT NULL,
+            content_type TEXT,
+            file_name TEXT,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (message_id, position)
         )
     ''')
 
+    # Key/value state shared between the importer and the web app
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value
+        )
+    ''')
+
+    conn.commit()
+    migrate(conn)
+
+    # T009: Triggers to keep FTS in sync with messages table. Also indexes
+    # any rows left behind by an interrupted bulk load.
+    end_bulk_load(conn)
+    conn.close()
+
+
+def migrate(conn):
+    """Bring a database created by an older version up to SCHEMA_VERSION."""
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA user_version')
+    version = cursor.fetchone()[0]
+
+    if version >= SCHEMA_VERSION:
+        return
+
+    cursor.execute('BEGIN IMMEDIATE')
+
+    if version < 2:
+        cursor.execute('PRAGMA table_info(messages)')
+        types = {row['name']: row['type'] for row in cursor.fetchall()}
+        if types.get('import_hash', '').upper() == 'TEXT':
+            convert_import_hash(conn)
+        # T012's index duplicated the UNIQUE constraint's own index
+        cursor.execute('DROP INDEX IF EXISTS idx_messages_import_hash')
+
+    if version < 3:
+        # Watermarks for incremental imports
+        add_columns(cursor, 'import_jobs', source='TEXT', max_timestamp='INTEGER')
+
+    if version < 4:
+        # Checkpoints for resumable imports
+        add_columns(cursor, 'import_jobs', byte_offset='INTEGER')
+
+    if version < 5:
+        # Prefix indexes for typeahead. FTS5 options are fixed at creation,
+        # so the index is recreated and rebuilt from messages.
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'")
+        if 'prefix=' not in cursor.fetchone()[0]:
+            cursor.execute('DROP TABLE messages_fts')
+            cursor.execute(FTS_TABLE_SQL)
+            cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+            # The rebuild covered any rows a bulk load left unindexed
+            cursor.execute("DELETE FROM meta WHERE key = 'fts_pending_from'")
+
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.commit()
+
+
+def add_columns(cursor, table, **columns):
+    """Add the given columns to `table` unless it already has them."""
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = {row['name'] for row in cursor.fetchall()}
+    for name, decl in columns.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+
+
+def compact_import_hash(value):
+    """Convert a legacy 64-char hex SHA-256 to the 16-byte binary digest."""
+    if isinstance(value, str) and len(value) == 64:
+        try:
+            return bytes.fromhex(value[:32])
+        except ValueError:
+            pass
+    return value
+
+
+def convert_import_hash(conn):
+    """
+    Rebuild messages in place with a binary import_hash column.
+
+    Runs inside the caller's transaction. Row ids are kept, so messages_fts
+    stays valid; the triggers are dropped with the old table and recreated
+    by init_db().
+    """
+    cursor = conn.cursor()
+    conn.create_function('compact_import_hash', 1, compact_import_hash,
+                         deterministic=True)
+
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'")
+    row = cursor.fetchone()
+    seq = row[0] if row else 0
+
+    cursor.execute('DROP TABLE IF EXISTS messages_new')
+    cursor.execute(MESSAGES_TABLE_SQL.format(name='messages_new'))
+    cursor.execute('''
+        INSERT INTO messages_new
+        (id, phone_number, contact_name, body, timestamp, message_type, import_hash)
+        SELECT id, phone_number, contact_name, body, timestamp, message_type,
+               compact_import_hash(import_hash)
+        FROM messages
+        ORDER BY id
+    ''')
+    cursor.execute('DROP TABLE messages')
+    cursor.execute('ALTER TABLE messages_new RENAME TO messages')
+    cursor.execute('''
+        UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'
+    ''', (seq,))
+
+    create_message_indexes(cursor)
+
+
+def create_message_indexes(cursor):
+    """Create the indexes on messages, which are dropped with the table."""
     # T011: Index for date sorting (FR-006: newest first)
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_messages_timestamp
         ON messages(timestamp DESC)
     ''')
 
-    # T012: Index for deduplication lookups
+    # Search filters and /api/conversation: one contact's, or one
+    # direction's, messages in date order. Every index ends with the rowid,
+    # so rows are ordered by id within a timestamp, as in search results.
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_messages_import_hash
-        ON messages(import_hash)
+        CREATE INDEX IF NOT EXISTS idx_messages_phone_timestamp
+        ON messages(phone_number, timestamp)
     ''')
-
-    # T008: FTS5 virtual table for full-text search
     cursor.execute('''
-        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
-            body,
-            content='messages',
-            content_rowid='id',
-            tokenize='porter unicode61'
-        )
+        CREATE INDEX IF NOT EXISTS idx_messages_type_timestamp
+        ON messages(message_type, timestamp)
     ''')
 
-    # T009: Triggers to keep FTS in sync with messages table
+
+def create_fts_triggers(cursor):
+    """Create the triggers that keep messages_fts in sync with messages."""
     cursor.execute('''
         CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
             INSERT INTO messages_fts(rowid, body) VALUES (new.id, new.body);
@@ -77,22 +456,58 @@ def init_db():
         END
     ''')
 
-    # T010: Import tracking table
+
+def drop_fts_triggers(cursor):
+    """Drop the FTS sync triggers (see begin_bulk_load)."""
+    for name in ('messages_ai', 'messages_ad', 'messages_au'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+def begin_bulk_load(conn):
+    """
+    Suspend per-row FTS indexing for a large import.
+
+    Records the highest message id before the load in meta and drops the
+    sync triggers in the same transaction. Rows inserted afterwards are only
+    indexed by end_bulk_load(), which init_db() also runs, so an import that
+    is killed midway is indexed by the next import or app start.
+    """
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    # Keep an older marker if a previous load was never finished
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS import_jobs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            file_name TEXT NOT NULL,
-            status TEXT NOT NULL DEFAULT 'pending',
-            total_messages INTEGER DEFAULT 0,
-            processed_messages INTEGER DEFAULT 0,
-            started_at INTEGER NOT NULL,
-            completed_at INTEGER,
-            error_message TEXT
-        )
+        INSERT OR IGNORE INTO meta (key, value)
+        SELECT 'fts_pending_from', COALESCE(MAX(id), 0) FROM messages
     ''')
+    drop_fts_triggers(cursor)
+    conn.commit()
+
 
+def end_bulk_load(conn):
+    """
+    Index rows loaded since begin_bulk_load() and restore the sync triggers.
+
+    An empty table before the load gets a single 'rebuild'; otherwise only
+    the new id range is inserted into messages_fts. A no-op apart from
+    creating the triggers when no bulk load is pending.
+    """
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute("SELECT value FROM meta WHERE key = 'fts_pending_from'")
+    row = cursor.fetchone()
+
+    if row is not None:
+        if row[0] == 0:
+            cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+        else:
+            cursor.execute('''
+                INSERT INTO messages_fts(rowid, body)
+                SELECT id, body FROM messages WHERE id > ?
+            ''', (row[0],))
+        cursor.execute("DELETE FROM meta WHERE key = 'fts_pending_from'")
+
+    create_fts_triggers(cursor)
     conn.commit()
-    conn.close()
 
 
 if __name__ == '__main__':
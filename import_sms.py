@@ -2,22 +2,85 @@
 """CLI script to import SMS Backup & Restore XML files into Retext database."""
 
 import argparse
+import binascii
+import bz2
+import gzip
 import hashlib
+import lzma
+import os
+import queue
+import stat
 import sys
+import tempfile
+import threading
 import time
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, closing
+from datetime import datetime
 from xml.etree.ElementTree import iterparse
+from xml.parsers import expat
 
 import db
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # optional, see parse_lxml
+    lxml_etree = None
+
+# T017: 1000-record transactions
+BATCH_SIZE = 1000
+
+# Bytes handed to the XML parser per read
+READ_SIZE = 64 * 1024
+
+# Fed to the parser before the rest of the file when resuming mid-document
+RESUME_PREFIX = b'<smses>'
+
+# A normalized chunk on its way to the writer: `consumed` is the number of
+# <sms> elements it covers and `offset` the input byte offset just past them
+Batch = namedtuple('Batch', ['rows', 'skipped', 'consumed', 'offset'])
+
+# Safety window for incremental imports: rows up to this much older than the
+# newest message of the previous import of the same source are still read
+WATERMARK_WINDOW_DAYS = 7
+
+# Base64 characters of an MMS attachment decoded at a time (a multiple of 4)
+ATTACHMENT_CHUNK = 1024 * 1024
+
+# Leading bytes that identify a compressed backup, whatever its file name
+COMPRESSED_FORMATS = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bz2',
+    b'\xfd7zXZ\x00': 'xz',
+    b'PK\x03\x04': 'zip',
+}
+
+# Returned by normalize_record for rows before the incremental watermark
+OLDER_THAN_WATERMARK = object()
+
+# Memory budget for the in-memory dedup prefilter (see load_known_keys).
+# A 16-byte key costs about 100 bytes as a member of a Python set.
+DEFAULT_PREFILTER_MB = 256
+PREFILTER_KEY_BYTES = 100
+
 
 def compute_import_hash(timestamp, phone_number, body):
-    """Compute SHA256 hash for deduplication (T016)."""
+    """Compute SHA256 hash for deduplication (T016).
+
+    Returns the first 16 bytes of the digest, stored as a BLOB.
+    """
     data = f"{timestamp}{phone_number}{body}"
-    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+    return hashlib.sha256(data.encode('utf-8')).digest()[:16]
 
 
 def count_messages(file_path):
-    """Count total messages in XML file for progress tracking."""
+    """Count total messages in XML file.
+
+    Costs a full parse of the file, so `import_xml` does not use it; progress
+    during import comes from the root `count` attribute instead.
+    """
     count = 0
     try:
         for event, elem in iterparse(file_path, events=['end']):
@@ -29,123 +92,1145 @@ def count_messages(file_path):
     return count
 
 
-def import_xml(file_path):
+class PrefixedReader:
+    """Binary reader that returns `prefix` before the rest of `raw`."""
+
+    def __init__(self, prefix, raw):
+        self.prefix = prefix
+        self.raw = raw
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.raw.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.raw.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+    def seekable(self):
+        return False
+
+
+class ProgressReader:
+    """Binary file wrapper that counts bytes consumed by the parser.
+
+    Only ever reads forward, so it works for pipes and other non-seekable
+    inputs where the total size is not known up front.
     """
-    Import SMS messages from XML backup file.
 
-    Returns tuple of (imported_count, duplicate_count, error_message).
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seekable(self):
+        seekable = getattr(self.raw, 'seekable', None)
+        return bool(seekable and seekable())
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.bytes_read = self.raw.seek(offset, whence)
+        return self.bytes_read
+
+    def tell(self):
+        return self.raw.tell()
+
+
+class QueueReader:
+    """Binary reader fed from another thread through a bounded queue.
+
+    The producer calls feed() for each piece of data and finish() (or
+    fail()) at the end. feed() blocks while `depth` pieces are waiting, so
+    a slow reader throttles the producer instead of letting data pile up.
+    Once the reading side calls close(), feed() returns False.
     """
-    # Initialize database
-    db.init_db()
-    conn = db.get_connection()
-    cursor = conn.cursor()
 
-    # Get total count for progress (T018)
-    print(f"Counting messages in {file_path}...")
-    total = count_messages(file_path)
-    if total is None:
-        return 0, 0, "Failed to parse XML file"
+    def __init__(self, depth=16):
+        self.queue = queue.Queue(maxsize=depth)
+        self.abandoned = threading.Event()
+        self.buffer = b''
+        self.eof = False
 
-    print(f"Found {total:,} messages")
+    def feed(self, data):
+        while not self.abandoned.is_set():
+            try:
+                self.queue.put(data, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    imported = 0
-    duplicates = 0
-    batch = []
-    batch_size = 1000  # T017: 1000-record transactions
+    def finish(self):
+        self.feed(None)
 
+    def fail(self, error):
+        self.feed(error)
+
+    def close(self):
+        self.abandoned.set()
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.buffer]
+            while not self.eof:
+                parts.append(self._next())
+            self.buffer = b''
+            return b''.join(parts)
+        if not self.buffer:
+            self.buffer = self._next()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _next(self):
+        if self.eof:
+            return b''
+        item = self.queue.get()
+        if item is None or isinstance(item, Exception):
+            self.eof = True
+            if item is not None:
+                raise item
+            return b''
+        return item
+
+
+def open_backup(source, stack):
+    """
+    Open a backup for streaming, decompressing gzip, bz2, xz and zip on the fly.
+
+    `source` is a path, '-' for stdin, or a binary file object. The format is
+    detected from the first bytes, so it works for pipes too; zip archives
+    need a seekable file. Everything opened is registered on `stack`.
+
+    Returns (stream, counter, size): `stream` yields the XML, `counter` is
+    the ProgressReader under any decompressor, so its bytes_read counts
+    compressed bytes, and `size` is that of the input file, if known.
+    """
+    if source == '-':
+        f = sys.stdin.buffer
+    elif isinstance(source, (str, os.PathLike)):
+        f = stack.enter_context(open(source, 'rb'))
+    else:
+        f = source
+
+    counter = ProgressReader(f)
+    size = input_size(f)
+    magic = counter.read(6)
+    if counter.seekable():
+        counter.seek(0)
+        raw = counter
+    else:
+        raw = PrefixedReader(magic, counter)
+
+    kind = next((kind for prefix, kind in COMPRESSED_FORMATS.items()
+                 if magic.startswith(prefix)), None)
+    if kind == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw, mode='rb')
+    elif kind == 'bz2':
+        stream = bz2.BZ2File(raw)
+    elif kind == 'xz':
+        stream = lzma.LZMAFile(raw)
+    elif kind == 'zip':
+        if raw is not counter:
+            raise ValueError('zip archives cannot be read from a pipe; '
+                             'use gzip, bz2 or xz instead')
+        archive = stack.enter_context(zipfile.ZipFile(raw))
+        stream = archive.open(zip_member(archive))
+    else:
+        return raw, counter, size
+    return stack.enter_context(stream), counter, size
+
+
+def zip_member(archive):
+    """Pick the SMS backup out of a zip archive."""
+    names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    candidates = [name for name in names if name.lower().endswith('.xml')] or names
+    if len(candidates) > 1:
+        # SMS Backup & Restore puts calls-*.xml next to sms-*.xml
+        sms = [name for name in candidates
+               if os.path.basename(name).lower().startswith('sms')]
+        candidates = sms or candidates
+    if len(candidates) != 1:
+        listed = ', '.join(candidates) or 'none'
+        raise ValueError(f'Expected one XML backup in the zip archive, found: {listed}')
+    return candidates[0]
+
+
+def input_size(f):
+    """Return the size in bytes of a regular file, or None (pipes, sockets)."""
     try:
-        # T014: Streaming XML parser using iterparse
-        context = iterparse(file_path, events=['end'])
+        st = os.fstat(f.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
 
-        for event, elem in context:
-            if elem.tag != 'sms':
-                continue
 
-            # T015: Extract message fields
-            phone_number = elem.get('address', '')
-            body = elem.get('body', '')
-            timestamp = elem.get('date', '0')
-            message_type = elem.get('type', '1')
-            contact_name = elem.get('contact_name')
+def format_progress(processed, total, bytes_read, size):
+    """Format a progress line from the root count or from bytes consumed."""
+    if total:
+        pct = processed / total * 100
+        return f"Progress: {processed:,} / {total:,} ({pct:.1f}%)"
+    if size:
+        pct = min(bytes_read / size * 100, 100.0)
+        return f"Progress: {processed:,} messages ({pct:.1f}% of input)"
+    return f"Progress: {processed:,} messages"
 
-            # Skip invalid messages
-            if not phone_number or not body:
-                elem.clear()  # T019: Clear element to bound memory
-                continue
 
-            # Convert types
+def iter_sms_chunks(stream, on_root, parser='expat', chunk_size=BATCH_SIZE,
+                    start_offset=0, min_timestamp=None):
+    """
+    Parse stage: stream `<sms>` and `<mms>` elements as chunks of raw records.
+
+    Yields (records, offset) pairs. Each record is (address, contact_name,
+    body, date, type) exactly as read from the file. MMS records carry a
+    sixth item, their attachments, which are already in the attachment
+    store by the time the record is yielded (see collect_part). `offset` is the input
+    byte offset just past the chunk, where a resumed import can pick up (see
+    skip_to), or None if the backend cannot tell. `on_root` is called with
+    the root element's attributes before the first message.
+
+    With `start_offset`, `stream` must already be positioned at that offset,
+    on an element boundary recorded by an earlier run. MMS dated before
+    `min_timestamp` are dropped by the hash stage, so their attachments are
+    not stored (see stores_parts).
+    """
+    return PARSERS[parser](stream, on_root, chunk_size, start_offset, min_timestamp)
+
+
+def parse_expat(stream, on_root, chunk_size=BATCH_SIZE, start_offset=0,
+                min_timestamp=None):
+    """
+    pyexpat parser backend.
+
+    A start-element handler copies attributes straight into record tuples
+    without building any tree. The only backend that reports byte offsets.
+    """
+    parser = expat.ParserCreate()
+    ready = []
+    chunk = []
+    seen_root = False
+    # (attrs, texts, attachments, store) of the <mms> being read
+    mms = None
+
+    def start_element(name, attrs):
+        nonlocal chunk, seen_root, mms
+        if not seen_root:
+            seen_root = True
+            on_root(attrs)
+            return
+        if name != 'sms' and name != 'mms':
+            if name == 'part' and mms is not None:
+                collect_part(attrs, mms[1], mms[2], mms[3])
+            return
+        if len(chunk) >= chunk_size:
+            ready.append((chunk, base + parser.CurrentByteIndex))
+            chunk = []
+        if name == 'mms':
+            mms = (attrs, [], [], stores_parts(attrs, min_timestamp))
+            # Only needed until </mms>; an end handler on every <sms>
+            # costs about a quarter of the parse time
+            parser.EndElementHandler = end_element
+            return
+
+        # T015: Extract message fields
+        chunk.append((
+            attrs.get('address', ''),
+            attrs.get('contact_name'),
+            attrs.get('body', ''),
+            attrs.get('date', '0'),
+            attrs.get('type', '1'),
+        ))
+
+    def end_element(name):
+        nonlocal mms
+        if name == 'mms':
+            chunk.append(mms_record(*mms[:3]))
+            mms = None
+            parser.EndElementHandler = None
+
+    parser.StartElementHandler = start_element
+
+    base = 0
+    if start_offset:
+        # Open a stand-in root so the rest of the document parses
+        parser.Parse(RESUME_PREFIX, False)
+        base = start_offset - len(RESUME_PREFIX)
+    fed = start_offset
+
+    while True:
+        data = stream.read(READ_SIZE)
+        if not data and fed == start_offset > 0:
+            # Resumed at the very end: nothing left, not even </smses>
+            break
+        fed += len(data)
+        try:
+            parser.Parse(data, not data)
+        except expat.ExpatError:
+            # Hand over what was parsed before the error first
+            yield from ready
+            raise
+        yield from ready
+        ready.clear()
+        if not data:
+            break
+
+    if chunk:
+        yield chunk, fed
+
+
+def parse_etree(stream, on_root, chunk_size=BATCH_SIZE, start_offset=0,
+                min_timestamp=None):
+    """ElementTree iterparse backend, the original T014 parser."""
+    if start_offset:
+        stream = PrefixedReader(RESUME_PREFIX, stream)
+    chunk = []
+    root = None
+    depth = 0
+    texts = attachments = None
+    store = True
+
+    for event, elem in iterparse(stream, events=['start', 'end']):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = elem
+                on_root(elem.attrib)
+            elif elem.tag == 'mms':
+                texts, attachments = [], []
+                store = stores_parts(elem.attrib, min_timestamp)
+            continue
+
+        depth -= 1
+        if elem.tag == 'sms':
+            chunk.append((
+                elem.get('address', ''),
+                elem.get('contact_name'),
+                elem.get('body', ''),
+                elem.get('date', '0'),
+                elem.get('type', '1'),
+            ))
+            # T019: Clear element after processing to bound memory
+            elem.clear()
+        elif elem.tag == 'part' and attachments is not None:
+            collect_part(elem.attrib, texts, attachments, store)
+            elem.clear()
+        elif elem.tag == 'mms':
+            chunk.append(mms_record(elem.attrib, texts, attachments))
+            texts = attachments = None
+            elem.clear()
+
+        if depth == 1:
+            # Cleared elements stay attached to the root; detach finished
+            # children so memory does not grow with the file
+            del root[:]
+
+        if len(chunk) >= chunk_size:
+            yield chunk, None
+            chunk = []
+
+    if chunk:
+        yield chunk, None
+
+
+def parse_lxml(stream, on_root, chunk_size=BATCH_SIZE, start_offset=0,
+               min_timestamp=None):
+    """lxml backend, using a parser target so no tree is built."""
+    if start_offset:
+        stream = PrefixedReader(RESUME_PREFIX, stream)
+    ready = []
+    chunk = []
+
+    class Target:
+        seen_root = False
+        mms = None
+
+        def start(self, tag, attrs):
+            nonlocal chunk
+            if not self.seen_root:
+                self.seen_root = True
+                on_root(attrs)
+                return
+            if tag == 'part' and self.mms is not None:
+                collect_part(attrs, *self.mms[1:])
+                return
+            if tag == 'mms':
+                self.mms = (dict(attrs), [], [], stores_parts(attrs, min_timestamp))
+                return
+            if tag != 'sms':
+                return
+            chunk.append((
+                attrs.get('address', ''),
+                attrs.get('contact_name'),
+                attrs.get('body', ''),
+                attrs.get('date', '0'),
+                attrs.get('type', '1'),
+            ))
+            self.flush()
+
+        def end(self, tag):
+            if tag == 'mms':
+                chunk.append(mms_record(*self.mms[:3]))
+                self.mms = None
+                self.flush()
+
+        def flush(self):
+            nonlocal chunk
+            if len(chunk) >= chunk_size:
+                ready.append((chunk, None))
+                chunk = []
+
+        def close(self):
+            pass
+
+    # huge_tree allows multi-MB attribute values (MMS attachments)
+    parser = lxml_etree.XMLParser(target=Target(), huge_tree=True, no_network=True)
+    while True:
+        data = stream.read(READ_SIZE)
+        try:
+            if data:
+                parser.feed(data)
+            else:
+                parser.close()
+        except lxml_etree.XMLSyntaxError:
+            yield from ready
+            raise
+        yield from ready
+        ready.clear()
+        if not data:
+            break
+
+    if chunk:
+        yield chunk, None
+
+
+def stores_parts(attrs, min_timestamp):
+    """
+    Whether to store the attachments of an `<mms>`: not when it is dated
+    before `min_timestamp`, as normalize_record will drop it anyway.
+    """
+    if min_timestamp is None:
+        return True
+    try:
+        return int(attrs.get('date', '0')) >= min_timestamp
+    except ValueError:
+        return True
+
+
+def collect_part(attrs, texts, attachments, store=True):
+    """
+    Add one `<part>` of an MMS to its message.
+
+    text/plain parts are appended to `texts` (the message body); parts with
+    base64 `data` are decoded into the attachment store and described in
+    `attachments`. SMIL layouts and undecodable data are dropped. Without
+    `store`, data parts are described with no sha256 or size and never
+    decoded; only for messages the hash stage drops (see stores_parts).
+    """
+    content_type = attrs.get('ct', '')
+    data = attrs.get('data')
+    if data:
+        sha256 = size = None
+        if store:
             try:
-                timestamp = int(timestamp)
-                message_type = int(message_type)
-            except ValueError:
-                elem.clear()
+                sha256, size = store_attachment(data)
+            except binascii.Error:
+                return
+        file_name = next((attrs[key] for key in ('name', 'cl', 'fn')
+                          if attrs.get(key) not in (None, '', 'null')), None)
+        attachments.append((content_type, file_name, sha256, size))
+    elif content_type == 'text/plain':
+        text = attrs.get('text')
+        if text and text != 'null':
+            texts.append(text)
+
+
+def mms_record(attrs, texts, attachments):
+    """Build the raw record for an `<mms>` from its attributes and parts."""
+    return (
+        attrs.get('address', ''),
+        attrs.get('contact_name'),
+        '\n'.join(texts),
+        attrs.get('date', '0'),
+        # msg_box uses the same numbering as the SMS type (1 inbox, 2 sent)
+        attrs.get('msg_box', '1'),
+        tuple(attachments),
+    )
+
+
+def store_attachment(data):
+    """
+    Decode a base64 MMS part into the content-addressed attachment store.
+
+    Decodes ATTACHMENT_CHUNK characters at a time, so the decoded bytes are
+    never all in memory. The data is hashed first and only decoded again
+    and written if the store does not have it yet, so re-imports write
+    nothing. Returns (sha256 hex digest, size).
+    """
+    digest = hashlib.sha256()
+    size = 0
+    for decoded in decode_base64_chunks(data):
+        digest.update(decoded)
+        size += len(decoded)
+
+    sha256 = digest.hexdigest()
+    directory = db.attachments_dir()
+    path = os.path.join(directory, sha256[:2], sha256)
+    if os.path.exists(path):
+        return sha256, size
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for decoded in decode_base64_chunks(data):
+                out.write(decoded)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return sha256, size
+
+
+def decode_base64_chunks(data):
+    """Decode base64 text ATTACHMENT_CHUNK characters at a time."""
+    pending = ''
+    for start in range(0, len(data), ATTACHMENT_CHUNK):
+        # Whitespace would shift the 4-character groups
+        piece = pending + ''.join(data[start:start + ATTACHMENT_CHUNK].split())
+        usable = len(piece) - len(piece) % 4
+        pending = piece[usable:]
+        yield binascii.a2b_base64(piece[:usable])
+    if pending:
+        yield binascii.a2b_base64(pending + '=' * (-len(pending) % 4))
+
+
+# Parser backends by name, default first (see choose_parser)
+PARSERS = {
+    'expat': parse_expat,
+    'lxml': parse_lxml,
+    'etree': parse_etree,
+}
+
+
+def choose_parser(name='auto'):
+    """
+    Resolve a backend name.
+
+    'auto' is expat: it measured faster than lxml on SMS backups, where
+    everything is in attributes, and only expat checkpoints byte offsets.
+    """
+    if name == 'auto':
+        return 'expat'
+    if name == 'lxml' and lxml_etree is None:
+        raise ValueError('The lxml parser backend requires lxml to be installed')
+    if name not in PARSERS:
+        raise ValueError(f'Unknown parser backend: {name}')
+    return name
+
+
+def skip_records(chunks, count):
+    """Drop the first `count` records, for resuming without a byte offset."""
+    for records, offset in chunks:
+        if count >= len(records):
+            count -= len(records)
+            continue
+        if count:
+            records = records[count:]
+            count = 0
+        yield records, offset
+
+
+def normalize_record(raw, min_timestamp=None):
+    """
+    Validate and convert a raw record into a row for insert_batch.
+
+    Returns None for invalid records and OLDER_THAN_WATERMARK, before any
+    hashing, for records dated before `min_timestamp`. Rows for MMS with
+    attachments carry them as a seventh item.
+    """
+    phone_number, contact_name, body, timestamp, message_type = raw[:5]
+    attachments = raw[5] if len(raw) > 5 else ()
+
+    # Skip invalid messages
+    if not phone_number or not (body or attachments):
+        return None
+
+    # Convert types
+    try:
+        timestamp = int(timestamp)
+        message_type = int(message_type)
+    except ValueError:
+        return None
+
+    if min_timestamp is not None and timestamp < min_timestamp:
+        return OLDER_THAN_WATERMARK
+
+    # T016: Compute import hash. Attachments are part of an MMS's identity.
+    key_body = body + ''.join(f'\0{part[2]}' for part in attachments)
+    import_hash = compute_import_hash(timestamp, phone_number, key_body)
+
+    row = (phone_number, contact_name, body, timestamp, message_type, import_hash)
+    return row + (attachments,) if attachments else row
+
+
+def normalize_chunk(chunk, min_timestamp=None):
+    """
+    Hash stage: normalize a chunk of raw records.
+
+    Returns (rows, skipped, seconds spent), where `skipped` counts records
+    older than `min_timestamp`. The timing lets the caller report stage
+    throughput even when this runs in a worker process.
+    """
+    start = time.perf_counter()
+    rows = []
+    skipped = 0
+    for raw in chunk:
+        row = normalize_record(raw, min_timestamp)
+        if row is OLDER_THAN_WATERMARK:
+            skipped += 1
+        elif row is not None:
+            rows.append(row)
+    return rows, skipped, time.perf_counter() - start
+
+
+def timed(iterable, timings, stage):
+    """Yield from `iterable`, adding the time spent producing items to timings[stage]."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            timings[stage] += time.perf_counter() - start
+        yield item
+
+
+def normalize_inline(chunks, timings, min_timestamp=None):
+    """Run the hash stage on the calling thread, yielding a Batch per chunk."""
+    for records, offset in chunks:
+        rows, skipped, elapsed = normalize_chunk(records, min_timestamp)
+        timings['hash'] += elapsed
+        yield Batch(rows, skipped, len(records), offset)
+
+
+def run_pipeline(chunks, workers, timings, min_timestamp=None):
+    """
+    Run the parse and hash stages concurrently.
+
+    Yields a Batch per chunk in file order, like normalize_inline.
+
+    A parser thread feeds raw chunks into a bounded queue, a pool of worker
+    processes normalizes and hashes them, and the caller consumes the
+    results as the single writer. At most `2 * workers` chunks are queued
+    and another `2 * workers` are in flight, so a slow writer blocks the
+    parser instead of letting memory grow.
+    """
+    depth = workers * 2
+    raw_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                raw_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
                 continue
 
-            # T016: Compute import hash
-            import_hash = compute_import_hash(timestamp, phone_number, body)
+    def parse():
+        try:
+            for chunk in timed(chunks, timings, 'parse'):
+                put(chunk)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(None)
 
-            batch.append((
-                phone_number,
-                contact_name,
-                body,
-                timestamp,
-                message_type,
-                import_hash
-            ))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Start the worker processes before the parser thread exists;
+        # forking a process that is running threads is unsafe
+        pool.submit(int).result()
+
+        parser = threading.Thread(target=parse, name='import-parser', daemon=True)
+        parser.start()
+        pending = deque()
+        error = None
+        done = False
+
+        try:
+            while pending or not done:
+                while not done and len(pending) < depth:
+                    item = raw_queue.get()
+                    if item is None:
+                        done = True
+                    elif isinstance(item, Exception):
+                        # Write what was parsed before the error first
+                        error = item
+                        done = True
+                    else:
+                        records, offset = item
+                        future = pool.submit(normalize_chunk, records, min_timestamp)
+                        pending.append((future, len(records), offset))
+
+                if pending:
+                    future, consumed, offset = pending.popleft()
+                    rows, skipped, elapsed = future.result()
+                    timings['hash'] += elapsed
+                    yield Batch(rows, skipped, consumed, offset)
+
+            if error is not None:
+                raise error
+        finally:
+            stop.set()
+            for future, consumed, offset in pending:
+                future.cancel()
+            parser.join()
+
+
+def load_known_keys(cursor, max_mb):
+    """
+    Load existing dedup keys into a set for the duplicate prefilter.
+
+    At most `max_mb` megabytes worth of keys are loaded. When the database
+    holds more, the keys of the most recently imported messages are kept,
+    since those are the ones a new backup overlaps with. A key in the set
+    is a certain duplicate; anything else still goes through SQLite.
+    """
+    limit = max_mb * 1024 * 1024 // PREFILTER_KEY_BYTES
+    if limit <= 0:
+        return set()
+
+    cursor.execute('SELECT MAX(id) FROM messages')
+    max_id = cursor.fetchone()[0] or 0
+    if max_id <= limit:
+        # Everything fits: a scan of the UNIQUE index is cheapest
+        cursor.execute('SELECT import_hash FROM messages')
+    else:
+        cursor.execute('''
+            SELECT import_hash FROM messages ORDER BY id DESC LIMIT ?
+        ''', (limit,))
+    return {row[0] for row in cursor}
+
+
+def format_throughput(counts, timings, workers, parser):
+    """Format per-stage throughput in messages per second."""
+    def rate(stage, parallel=1):
+        busy = timings[stage] / parallel
+        return f"{counts[stage] / busy:,.0f}/s" if busy > 0 else "n/a"
+
+    hash_rate = rate('hash', max(workers, 1))
+    if workers:
+        hash_rate += f" ({workers} workers)"
+    return (f"Throughput: parse {rate('parse')} ({parser}), hash {hash_rate}, "
+            f"write {rate('write')}")
+
+
+def import_xml(source, bulk_load=None, workers=0,
+               prefilter_mb=DEFAULT_PREFILTER_MB, backup_source=None,
+               incremental=True, resume=False, parser='auto', job_id=None,
+               quiet=False):
+    """
+    Import SMS messages from XML backup file.
+
+    `source` is a path, '-' for stdin, or a binary file object (which may be
+    a pipe). gzip, bz2, xz and zip backups are decompressed as they are read
+    (see open_backup). The file is parsed exactly once: progress comes from
+    the `<smses count="...">` root attribute, or from (compressed) bytes
+    consumed versus file size without it.
+
+    With `bulk_load` the FTS sync triggers are suspended and messages_fts
+    is filled once at the end (see db.begin_bulk_load). The default (None)
+    uses bulk loading for the initial import into an empty database.
+
+    With `workers` > 0, parsing runs on its own thread and hashing on that
+    many worker processes (see run_pipeline); this thread stays the only
+    one touching SQLite.
+
+    Keys already in the database are loaded into memory once, up to
+    `prefilter_mb` megabytes (0 disables it), and known duplicates are
+    dropped before they reach SQLite (see load_known_keys).
+
+    Every import is recorded in import_jobs. When `backup_source` names
+    where the backup came from (e.g. a phone) and `incremental` is set,
+    messages older than the newest one of the last completed import of
+    that source, minus WATERMARK_WINDOW_DAYS, are skipped before hashing.
+
+    Progress is checkpointed into the job after every committed batch. With
+    `resume`, an unfinished job for the same file name continues from its
+    last checkpoint instead of starting over.
+
+    `parser` picks the XML backend from PARSERS (see choose_parser).
+
+    With `job_id`, the import is recorded in that job, already created by
+    the caller with start_job(), instead of a new one. `quiet` suppresses
+    progress output, for imports run by the web app.
+
+    Returns tuple of (imported_count, duplicate_count, error_message).
+    """
+    echo = (lambda *args: None) if quiet else print
+
+    stack = ExitStack()
+    try:
+        parser = choose_parser(parser)
+        stream, reader, size = open_backup(source, stack)
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        stack.close()
+        if job_id is not None:
+            with closing(db.get_connection()) as conn:
+                finish_job(conn, job_id, 'failed', None, None, None, str(e))
+        return 0, 0, str(e)
+
+    # Set up inside the try, so a failure here (e.g. the database locked by
+    # another import) still marks the job failed
+    conn = None
+    bulk_loading = False
+    imported = 0
+    duplicates = 0
+    progress = {'total': None}
+    try:
+        # Initialize database
+        db.init_db()
+        conn = db.get_connection()
+        cursor = conn.cursor()
+
+        if source == '-':
+            file_name = '<stdin>'
+        elif isinstance(source, (str, os.PathLike)):
+            file_name = str(source)
+        else:
+            file_name = '<stream>'
+        job = find_resumable_job(cursor, file_name) if resume and job_id is None else None
+        if job is not None:
+            job_id = job['id']
+            # Backends other than expat only checkpoint a record count
+            start_offset = job['byte_offset'] or 0
+            processed = job['processed_messages']
+            max_timestamp = job['max_timestamp']
+            restart_job(conn, job_id)
+            echo(f"Resuming after {processed:,} messages")
+        else:
+            if resume:
+                echo(f"No unfinished import of {file_name}; starting from the beginning")
+            if job_id is None:
+                job_id = start_job(conn, file_name, backup_source)
+            start_offset = 0
+            processed = 0
+            max_timestamp = None
+
+        min_timestamp = None
+        if backup_source and incremental:
+            watermark = get_watermark(cursor, backup_source)
+            if watermark is not None:
+                min_timestamp = watermark - WATERMARK_WINDOW_DAYS * 86400 * 1000
+                echo(f"Incremental import: reading messages from "
+                      f"{format_date(min_timestamp)} on (last import of {backup_source})")
+
+        if bulk_load is None:
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM messages)')
+            bulk_load = not cursor.fetchone()[0]
+        if bulk_load:
+            db.begin_bulk_load(conn)
+            bulk_loading = True
+
+        known_keys = set()
+        if prefilter_mb and not bulk_load:
+            known_keys = load_known_keys(cursor, prefilter_mb)
+            echo(f"Loaded {len(known_keys):,} known messages for duplicate checks")
+        prefiltered = 0
+
+        if job is not None:
+            progress['total'] = job['total_messages'] or None
+
+        def on_root(attrs):
+            # Single pass: take the total from the root element instead of
+            # counting the file beforehand (T018)
+            total = parse_count(attrs.get('count'))
+            if total is not None:
+                progress['total'] = total
+                echo(f"Found {total:,} messages")
 
-            # T017: Batch insert with 1000-record transactions
-            if len(batch) >= batch_size:
-                result = insert_batch(cursor, batch)
-                imported += result['inserted']
-                duplicates += result['duplicates']
-                batch = []
+        older = 0
+        timings = {'parse': 0.0, 'hash': 0.0, 'write': 0.0}
+        counts = {'parse': 0, 'hash': 0, 'write': 0}
+
+        def count_chunks(chunks):
+            for records, offset in chunks:
+                counts['parse'] += len(records)
+                counts['hash'] += len(records)
+                yield records, offset
+
+        if start_offset:
+            skip_to(stream, start_offset)
+
+        chunks = iter_sms_chunks(stream, on_root, parser,
+                                 start_offset=start_offset, min_timestamp=min_timestamp)
+        if job is not None and not start_offset:
+            chunks = skip_records(chunks, processed)
+        chunks = count_chunks(chunks)
+        if workers > 0:
+            results = run_pipeline(chunks, workers, timings, min_timestamp)
+        else:
+            results = normalize_inline(timed(chunks, timings, 'parse'), timings,
+                                       min_timestamp)
+
+        with closing(results):
+            for batch in results:
+                start = time.perf_counter()
+                rows = batch.rows
+                counts['write'] += len(rows)
+                older += batch.skipped
+                processed += batch.consumed
+                # A running max: backups are often newest first
+                max_timestamp = max(filter(None, [max_timestamp, *(row[3] for row in rows)]),
+                                    default=None)
+                if known_keys:
+                    new_rows = [row for row in rows if row[5] not in known_keys]
+                    prefiltered += len(rows) - len(new_rows)
+                    duplicates += len(rows) - len(new_rows)
+                    rows = new_rows
+
+                # T017: Batch insert with 1000-record transactions. The
+                # checkpoint commits with the rows it covers.
+                if rows:
+                    result = insert_batch(cursor, rows)
+                    imported += result['inserted']
+                    duplicates += result['duplicates']
+                checkpoint_job(cursor, job_id, processed, batch.offset,
+                               progress['total'], max_timestamp)
                 conn.commit()
+                timings['write'] += time.perf_counter() - start
 
                 # T018: Progress output
-                processed = imported + duplicates
-                pct = (processed / total * 100) if total > 0 else 0
-                print(f"Progress: {processed:,} / {total:,} ({pct:.1f}%)")
+                echo(format_progress(processed, progress['total'],
+                                      reader.bytes_read, size))
 
-            # T019: Clear element after processing to bound memory
-            elem.clear()
+        finish_job(conn, job_id, 'completed', processed, progress['total'],
+                   max_timestamp)
 
-        # Insert remaining batch
-        if batch:
-            result = insert_batch(cursor, batch)
-            imported += result['inserted']
-            duplicates += result['duplicates']
-            conn.commit()
-
-        conn.close()
+        echo(format_throughput(counts, timings, workers, parser))
+        if known_keys:
+            echo(f"Prefilter: {prefiltered:,} duplicates skipped before the database")
+        if min_timestamp is not None:
+            echo(f"Incremental: {older:,} older messages skipped")
         return imported, duplicates, None
 
     except Exception as e:
         # T020: Error handling for malformed XML
-        conn.close()
+        if conn is not None:
+            conn.rollback()
+            finish_job(conn, job_id, 'failed', None, progress['total'], None, str(e))
+        elif job_id is not None:
+            with closing(db.get_connection()) as failed_conn:
+                finish_job(failed_conn, job_id, 'failed', None, None, None, str(e))
         return imported, duplicates, str(e)
 
+    finally:
+        if bulk_loading:
+            # Drop any half-written batch, then index what was committed
+            conn.rollback()
+            echo("Building search index...")
+            db.end_bulk_load(conn)
+        if conn is not None:
+            # Fold the import's WAL back into the database file
+            db.checkpoint(conn)
+            conn.close()
+        stack.close()
+
+
+def start_job(conn, file_name, backup_source=None):
+    """Record a running import in import_jobs and return its id."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO import_jobs (file_name, status, started_at, source)
+        VALUES (?, 'running', ?, ?)
+    ''', (file_name, int(time.time()), backup_source))
+    conn.commit()
+    return cursor.lastrowid
+
+
+def checkpoint_job(cursor, job_id, processed, byte_offset, total, max_timestamp):
+    """Record progress for a running job; commit it with the batch it covers."""
+    cursor.execute('''
+        UPDATE import_jobs
+        SET processed_messages = ?, byte_offset = ?,
+            total_messages = COALESCE(?, total_messages), max_timestamp = ?
+        WHERE id = ?
+    ''', (processed, byte_offset, total, max_timestamp, job_id))
+
+
+def finish_job(conn, job_id, status, processed, total, max_timestamp, error=None):
+    """
+    Mark an import job completed or failed.
+
+    None for `processed` or `max_timestamp` keeps the last checkpoint.
+    """
+    conn.execute('''
+        UPDATE import_jobs
+        SET status = ?, processed_messages = COALESCE(?, processed_messages),
+            total_messages = COALESCE(?, total_messages),
+            max_timestamp = COALESCE(?, max_timestamp),
+            completed_at = ?, error_message = ?
+        WHERE id = ?
+    ''', (status, processed, total, max_timestamp, int(time.time()), error, job_id))
+    conn.commit()
+
+
+def find_resumable_job(cursor, file_name):
+    """Return the newest unfinished job for `file_name` with a checkpoint, or None."""
+    cursor.execute('''
+        SELECT * FROM import_jobs
+        WHERE file_name = ? AND status IN ('running', 'failed')
+          AND (byte_offset IS NOT NULL OR processed_messages > 0)
+        ORDER BY id DESC
+        LIMIT 1
+    ''', (file_name,))
+    return cursor.fetchone()
+
+
+def restart_job(conn, job_id):
+    """Mark a resumed job as running again."""
+    conn.execute('''
+        UPDATE import_jobs
+        SET status = 'running', completed_at = NULL, error_message = NULL
+        WHERE id = ?
+    ''', (job_id,))
+    conn.commit()
+
+
+def skip_to(f, offset):
+    """Move an input to `offset`, reading and discarding if it cannot seek."""
+    if f.seekable():
+        f.seek(offset)
+        return
+    remaining = offset
+    while remaining > 0:
+        data = f.read(min(remaining, 1024 * 1024))
+        if not data:
+            raise ValueError('Input is shorter than the resume checkpoint')
+        remaining -= len(data)
+
+
+def get_watermark(cursor, backup_source):
+    """Return the newest message timestamp imported from `backup_source`, or None."""
+    cursor.execute('''
+        SELECT MAX(max_timestamp) FROM import_jobs
+        WHERE source = ? AND status = 'completed'
+    ''', (backup_source,))
+    return cursor.fetchone()[0]
+
+
+def format_date(timestamp_ms):
+    """Format a millisecond timestamp as a date for CLI output."""
+    return datetime.fromtimestamp(timestamp_ms / 1000).strftime('%Y-%m-%d')
+
+
+def parse_count(value):
+    """Parse the root `count` attribute, returning None if absent or bogus."""
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        return None
+    return count if count >= 0 else None
+
 
 def insert_batch(cursor, batch):
-    """Insert batch of messages, handling duplicates via INSERT OR IGNORE."""
-    inserted = 0
-    duplicates = 0
+    """
+    Insert batch of messages, handling duplicates via INSERT OR IGNORE.
 
-    for record in batch:
-        try:
-            cursor.execute('''
-                INSERT OR IGNORE INTO messages
-                (phone_number, contact_name, body, timestamp, message_type, import_hash)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', record)
-
-            if cursor.rowcount > 0:
-                inserted += 1
-            else:
-                duplicates += 1
-        except Exception:
-            duplicates += 1
+    The batch is loaded into a temp staging table with one executemany()
+    and merged into messages with a single INSERT OR IGNORE ... SELECT, so
+    a batch costs a couple of statements instead of one per row. The
+    inserted count comes from changes(); everything else was a duplicate.
+
+    Attachments of MMS rows (a seventh item, see normalize_record) are
+    linked to the messages this call inserted; duplicates keep their own.
+    """
+    attachments = [
+        (row[5], position, *part)
+        for row in batch if len(row) > 6
+        for position, part in enumerate(row[6])
+    ]
+    if attachments:
+        # AUTOINCREMENT: everything inserted below gets a larger id
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+        last_id = cursor.fetchone()[0]
+        batch = [row[:6] for row in batch]
+
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS import_staging (
+            phone_number TEXT,
+            contact_name TEXT,
+            body TEXT,
+            timestamp INTEGER,
+            message_type INTEGER,
+            import_hash BLOB
+        )
+    ''')
+    cursor.execute('DELETE FROM import_staging')
+    cursor.executemany('''
+        INSERT INTO import_staging
+        (phone_number, contact_name, body, timestamp, message_type, import_hash)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', batch)
+
+    # Keep file order so message ids follow the backup
+    cursor.execute('''
+        INSERT OR IGNORE INTO messages
+        (phone_number, contact_name, body, timestamp, message_type, import_hash)
+        SELECT phone_number, contact_name, body, timestamp, message_type, import_hash
+        FROM import_staging
+        ORDER BY rowid
+    ''')
+    cursor.execute('SELECT changes()')
+    inserted = cursor.fetchone()[0]
+
+    if attachments and inserted:
+        insert_attachments(cursor, attachments, last_id)
 
-    return {'inserted': inserted, 'duplicates': duplicates}
+    return {'inserted': inserted, 'duplicates': len(batch) - inserted}
+
+
+def insert_attachments(cursor, attachments, last_id):
+    """
+    Record stored attachments for messages inserted after `last_id`.
+
+    `attachments` holds (import_hash, position, content_type, file_name,
+    sha256, size) tuples; they are matched to messages by import_hash.
+    """
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS import_attachments (
+            import_hash BLOB,
+            position INTEGER,
+            content_type TEXT,
+            file_name TEXT,
+            sha256 TEXT,
+            size INTEGER
+        )
+    ''')
+    cursor.execute('DELETE FROM import_attachments')
+    cursor.executemany('''
+        INSERT INTO import_attachments VALUES (?, ?, ?, ?, ?, ?)
+    ''', attachments)
+    # OR IGNORE: an MMS repeated within one batch is inserted once
+    cursor.execute('''
+        INSERT OR IGNORE INTO attachments
+        (message_id, position, content_type, file_name, sha256, size)
+        SELECT m.id, s.position, s.content_type, s.file_name, s.sha256, s.size
+        FROM import_attachments s
+        JOIN messages m ON m.import_hash = s.import_hash
+        WHERE m.id > ?
+    ''', (last_id,))
 
 
 def main():
@@ -156,15 +1241,80 @@ def main():
     )
     parser.add_argument(
         'file',
-        help='Path to SMS Backup & Restore XML file'
+        help='Path to SMS Backup & Restore XML file, optionally compressed '
+             '(.gz, .bz2, .xz, .zip), or - to read from stdin'
+    )
+    parser.add_argument(
+        '--bulk-load',
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help='Build the search index once after loading instead of per row '
+             '(default: only when the database is empty)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Hash records on N worker processes while parsing on a separate '
+             'thread (default: 0, everything on one thread)'
+    )
+
+    parser.add_argument(
+        '--prefilter-mb',
+        type=int,
+        default=DEFAULT_PREFILTER_MB,
+        metavar='MB',
+        help='Memory for the in-memory duplicate prefilter '
+             f'(default: {DEFAULT_PREFILTER_MB}, 0 disables it)'
+    )
+
+    parser.add_argument(
+        '--source',
+        metavar='NAME',
+        help='Name of the phone or backup set this file comes from. Later '
+             'imports from the same source skip messages older than the '
+             f'last one imported (minus {WATERMARK_WINDOW_DAYS} days)'
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Read every message even if --source has been imported before'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an interrupted import of the same file from its last '
+             'checkpoint'
+    )
+
+    parser.add_argument(
+        '--parser',
+        choices=['auto', *PARSERS],
+        default='auto',
+        help='XML parser backend (default: expat; lxml must be installed)'
     )
 
     args = parser.parse_args()
+    if args.workers < 0:
+        parser.error('--workers must be 0 or more')
+    if args.prefilter_mb < 0:
+        parser.error('--prefilter-mb must be 0 or more')
 
     print(f"Importing: {args.file}")
     start_time = time.time()
 
-    imported, duplicates, error = import_xml(args.file)
+    imported, duplicates, error = import_xml(
+        args.file,
+        bulk_load=args.bulk_load,
+        workers=args.workers,
+        prefilter_mb=args.prefilter_mb,
+        backup_source=args.source,
+        incremental=not args.full,
+        resume=args.resume,
+        parser=args.parser,
+    )
 
     elapsed = time.time() - start_time
 
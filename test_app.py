@@ -1,6 +1,19 @@
 """Tests for Flask application routes."""
 
+import gzip
+import io
 import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+import app as app_module
+import db as db_module
+import import_sms
 
 
 class TestHealthEndpoint:
@@ -93,6 +106,12 @@ class TestProtectedRoutes:
 
         assert response.status_code == 302
 
+    def test_api_imports_requires_auth(self, client):
+        """Test that the upload endpoint redirects when not authenticated."""
+        response = client.post('/api/imports', data=b'<smses />', follow_redirects=False)
+
+        assert response.status_code == 302
+
     def test_api_search_requires_auth(self, client):
         """Test that search API redirects when not authenticated."""
         response = client.get('/api/search?q=test', follow_redirects=False)
@@ -100,6 +119,24 @@ class TestProtectedRoutes:
         assert response.status_code == 302
 
 
+    def test_api_messages_requires_auth(self, client):
+        """Test that the message API redirects when not authenticated."""
+        response = client.get('/api/messages/1', follow_redirects=False)
+
+        assert response.status_code == 302
+
+    def test_api_suggest_requires_auth(self, client):
+        """Test that the typeahead API redirects when not authenticated."""
+        response = client.get('/api/suggest?q=pa', follow_redirects=False)
+
+        assert response.status_code == 302
+
+    def test_api_conversation_requires_auth(self, client):
+        """Test that the conversation API redirects when not authenticated."""
+        response = client.get('/api/conversation/%2B15551234567', follow_redirects=False)
+
+        assert response.status_code == 302
+
 class TestIndexPage:
     """Tests for the main index page."""
 
@@ -208,6 +245,133 @@ class TestSearchAPI:
         assert '<mark>' in result['body']
         assert '</mark>' in result['body']
 
+    def test_search_highlights_stemmed_matches(self, authenticated_client, sample_messages):
+        """Test that highlights follow the porter stemmer, not the literal query."""
+        data = authenticated_client.get('/api/search?q=come').get_json()
+
+        assert data['results'][0]['body'] == \
+            'Hey, are you <mark>coming</mark> to the party tonight?'
+
+    def test_search_escapes_body_html(self, authenticated_client, temp_db):
+        """Test that message bodies cannot inject markup."""
+        conn = db_module.get_connection()
+        conn.execute('''
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', '<script>alert("x")</script> party & <mark>', 1, 1, x'01')
+        ''')
+        conn.commit()
+        conn.close()
+
+        data = authenticated_client.get('/api/search?q=party').get_json()
+
+        assert data['results'][0]['body'] == (
+            '&lt;script&gt;alert(&quot;x&quot;)&lt;/script&gt; '
+            '<mark>party</mark> &amp; &lt;mark&gt;')
+
+    def _insert_long(self):
+        """Insert a 60-word message with 'party' near the end; return its id."""
+        words = [f'word{i}' for i in range(60)]
+        words[50] = 'party'
+        conn = db_module.get_connection()
+        cursor = conn.execute('''
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', ?, 1800000000000, 1, x'02')
+        ''', (' '.join(words),))
+        conn.commit()
+        conn.close()
+        return cursor.lastrowid
+
+    def test_search_snippet(self, authenticated_client, temp_db):
+        """Test that snippet=N cuts long bodies down to the matches."""
+        self._insert_long()
+
+        data = authenticated_client.get('/api/search?q=party&snippet=8').get_json()
+        result = data['results'][0]
+
+        assert result['truncated'] is True
+        assert result['body'].startswith('\u2026')
+        assert '<mark>party</mark>' in result['body']
+        assert len(result['body'].split()) <= 9
+
+    def test_search_snippet_short_body(self, authenticated_client, sample_messages):
+        """Test that bodies shorter than the window are returned whole."""
+        data = authenticated_client.get('/api/search?q=party&snippet=16').get_json()
+        result = data['results'][0]
+
+        assert result['truncated'] is False
+        assert result['body'] == 'Hey, are you coming to the <mark>party</mark> tonight?'
+
+    @pytest.mark.parametrize('snippet', ['0', '65', 'long'])
+    def test_search_invalid_snippet(self, authenticated_client, sample_messages, snippet):
+        """Test that snippet sizes FTS5 cannot produce are rejected."""
+        response = authenticated_client.get(f'/api/search?q=party&snippet={snippet}')
+
+        assert response.status_code == 400
+
+    def _insert_bodies(self, bodies):
+        """Insert (body, timestamp) pairs; return their ids."""
+        conn = db_module.get_connection()
+        ids = []
+        for i, (body, timestamp) in enumerate(bodies):
+            cursor = conn.execute('''
+                INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+                VALUES ('+15551234567', ?, ?, 1, ?)
+            ''', (body, timestamp, (1000 + i).to_bytes(16, 'big')))
+            ids.append(cursor.lastrowid)
+        conn.commit()
+        conn.close()
+        return ids
+
+    def test_search_sort_relevance(self, authenticated_client, temp_db):
+        """Test that sort=relevance puts the best bm25 match first."""
+        day = 86_400_000
+        weak, strong = self._insert_bodies([
+            ('pizza then a long list of other things to talk about', 1700000000000 + day),
+            ('pizza pizza pizza', 1700000000000),
+        ])
+
+        by_date = authenticated_client.get('/api/search?q=pizza').get_json()
+        by_rank = authenticated_client.get('/api/search?q=pizza&sort=relevance').get_json()
+
+        assert [r['id'] for r in by_date['results']] == [weak, strong]
+        assert [r['id'] for r in by_rank['results']] == [strong, weak]
+
+    def test_search_sort_hybrid(self, authenticated_client, temp_db):
+        """Test that sort=hybrid breaks a relevance tie in favour of the newer message."""
+        year = 365 * 86_400_000
+        old, new = self._insert_bodies([
+            ('pizza tonight', 1700000000000 - year),
+            ('pizza tonight', 1700000000000),
+        ])
+
+        by_rank = authenticated_client.get('/api/search?q=pizza&sort=relevance').get_json()
+        hybrid = authenticated_client.get('/api/search?q=pizza&sort=hybrid').get_json()
+
+        assert [r['id'] for r in by_rank['results']] == [old, new]
+        assert [r['id'] for r in hybrid['results']] == [new, old]
+
+    @pytest.mark.parametrize('sort', ['relevance', 'hybrid'])
+    def test_search_ranked_cursor_walks_all_results(self, authenticated_client, temp_db, sort):
+        """Test that cursors page through tied scores without gaps or repeats."""
+        self._insert_many(120)
+
+        ids = []
+        url = f'/api/search?q=lunch&sort={sort}'
+        data = authenticated_client.get(url).get_json()
+        while True:
+            ids.extend(r['id'] for r in data['results'])
+            if not data['next_cursor']:
+                break
+            data = authenticated_client.get(f'{url}&cursor={data["next_cursor"]}').get_json()
+
+        assert len(ids) == len(set(ids)) == 120
+
+    def test_search_invalid_sort(self, authenticated_client, sample_messages):
+        """Test that an unknown sort is rejected."""
+        response = authenticated_client.get('/api/search?q=party&sort=random')
+
+        assert response.status_code == 400
+
     def test_search_pagination_info(self, authenticated_client, sample_messages):
         """Test that search returns pagination information."""
         response = authenticated_client.get('/api/search?q=the')
@@ -232,6 +396,784 @@ class TestSearchAPI:
         data = json.loads(response.data)
         assert data['page'] == 1
 
+    def _insert_many(self, count, start=0):
+        """Insert `count` messages matching 'lunch', in timestamp ties of three."""
+        conn = db_module.get_connection()
+        conn.executemany('''
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', ?, ?, 1, ?)
+        ''', [(f'lunch {i}', 1700000000000 + i // 3, i.to_bytes(16, 'big'))
+              for i in range(start, start + count)])
+        conn.commit()
+        conn.close()
+
+    def test_search_cursor_walks_all_results(self, authenticated_client, temp_db):
+        """Test that following next_cursor visits every match once, in order."""
+        self._insert_many(120)
+        first = authenticated_client.get('/api/search?q=lunch').get_json()
+
+        ids = [r['id'] for r in first['results']]
+        data = first
+        while data['next_cursor']:
+            data = authenticated_client.get(
+                f'/api/search?q=lunch&cursor={data["next_cursor"]}').get_json()
+            assert 'page' not in data
+            ids.extend(r['id'] for r in data['results'])
+
+        assert first['has_more'] is True
+        assert len(ids) == len(set(ids)) == 120
+        assert data['has_more'] is False
+
+        by_page = []
+        for page in (1, 2, 3):
+            response = authenticated_client.get(f'/api/search?q=lunch&page={page}')
+            by_page.extend(r['id'] for r in response.get_json()['results'])
+        assert ids == by_page
+
+    def test_search_last_page_has_no_cursor(self, authenticated_client, sample_messages):
+        """Test that a page with nothing after it returns no cursor."""
+        data = authenticated_client.get('/api/search?q=party').get_json()
+
+        assert data['has_more'] is False
+        assert data['next_cursor'] is None
+
+    @pytest.mark.parametrize('cursor', ['garbage!', 'e30', 'WzEsIngiXQ'])
+    def test_search_invalid_cursor(self, authenticated_client, sample_messages, cursor):
+        """Test that a malformed cursor is rejected."""
+        response = authenticated_client.get(f'/api/search?q=party&cursor={cursor}')
+
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Invalid cursor'
+
+    def test_search_count_capped(self, authenticated_client, temp_db, monkeypatch):
+        """Test that the default count stops at SEARCH_COUNT_CAP."""
+        monkeypatch.setattr(app_module, 'SEARCH_COUNT_CAP', 100)
+        self._insert_many(120)
+
+        data = authenticated_client.get('/api/search?q=lunch').get_json()
+
+        assert data['total'] == 100
+        assert data['total_exact'] is False
+
+    def test_search_count_exact(self, authenticated_client, temp_db, monkeypatch):
+        """Test that count=exact counts every match."""
+        monkeypatch.setattr(app_module, 'SEARCH_COUNT_CAP', 100)
+        self._insert_many(120)
+
+        data = authenticated_client.get('/api/search?q=lunch&count=exact').get_json()
+
+        assert data['total'] == 120
+        assert data['total_exact'] is True
+
+    def test_search_count_none(self, authenticated_client, sample_messages):
+        """Test that count=none skips the count."""
+        data = authenticated_client.get('/api/search?q=party&count=none').get_json()
+
+        assert data['total'] is None
+        assert len(data['results']) == 1
+
+    def test_search_invalid_count_mode(self, authenticated_client, sample_messages):
+        """Test that an unknown count mode is rejected."""
+        response = authenticated_client.get('/api/search?q=party&count=fast')
+
+        assert response.status_code == 400
+
+    def test_search_cursor_carries_total(self, authenticated_client, temp_db):
+        """Test that later pages reuse the first page's count."""
+        self._insert_many(60)
+        first = authenticated_client.get('/api/search?q=lunch').get_json()
+        self._insert_many(80, start=60)
+
+        second = authenticated_client.get(
+            f'/api/search?q=lunch&cursor={first["next_cursor"]}').get_json()
+
+        assert first['total'] == second['total'] == 60
+
+
+class TestSearchFilters:
+    """Tests for the phone, from, to and type filters on /api/search."""
+
+    PHONES = ('+15550000001', '+15550000002', '+15550000003')
+
+    def _insert_messages(self):
+        """
+        Insert 60 'lunch' messages, one a day from 2021-01-01, cycling
+        through PHONES and alternating received and sent; every tenth
+        also mentions dinner. Return them as (id, phone, timestamp, type).
+        """
+        start = datetime(2021, 1, 1)
+        conn = db_module.get_connection()
+        messages = []
+        for i in range(60):
+            phone = self.PHONES[i % 3]
+            timestamp = int(start.timestamp() * 1000) + i * 86_400_000
+            message_type = i % 2 + 1
+            body = f'lunch {i} and dinner' if i % 10 == 0 else f'lunch {i}'
+            cursor = conn.execute('''
+                INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (phone, body, timestamp, message_type, i.to_bytes(16, 'big')))
+            messages.append((cursor.lastrowid, phone, timestamp, message_type))
+        conn.commit()
+        conn.close()
+        return messages
+
+    def _search_all(self, client, url):
+        """Follow next_cursor from `url`; return the first page and every id."""
+        first = data = client.get(url).get_json()
+        ids = [r['id'] for r in data['results']]
+        while data['next_cursor']:
+            data = client.get(f'{url}&cursor={data["next_cursor"]}').get_json()
+            ids.extend(r['id'] for r in data['results'])
+        return first, ids
+
+    def test_phone_filter(self, authenticated_client, temp_db):
+        """Test that phone= keeps one contact's messages."""
+        messages = self._insert_messages()
+
+        data = authenticated_client.get('/api/search?q=lunch&phone=%2B15550000002').get_json()
+
+        assert data['total'] == 20
+        assert {r['phone_number'] for r in data['results']} == {'+15550000002'}
+        assert [r['id'] for r in data['results']] == [
+            m[0] for m in reversed(messages) if m[1] == '+15550000002']
+
+    def test_date_range_includes_both_days(self, authenticated_client, temp_db):
+        """Test that from= and to= are local dates, both included."""
+        messages = self._insert_messages()
+
+        data = authenticated_client.get('/api/search?q=lunch&from=2021-01-03&to=2021-01-05').get_json()
+
+        assert [r['id'] for r in data['results']] == [m[0] for m in messages[4:1:-1]]
+
+    def test_type_filter(self, authenticated_client, temp_db):
+        """Test that type= keeps received or sent messages."""
+        self._insert_messages()
+
+        data = authenticated_client.get('/api/search?q=lunch&type=2').get_json()
+
+        assert data['total'] == 30
+        assert {r['message_type'] for r in data['results']} == {2}
+
+    @pytest.mark.parametrize('sort', ['date', 'relevance', 'hybrid'])
+    @pytest.mark.parametrize('query', ['lunch', 'dinner'])
+    @pytest.mark.parametrize('walk_index', [True, False])
+    def test_filtered_cursor_walks_all_results(self, authenticated_client, temp_db, monkeypatch,
+                                               sort, query, walk_index):
+        """Test that either plan finds every filtered match once, with the right total."""
+        monkeypatch.setattr(app_module, 'prefer_index', lambda *args: walk_index)
+        messages = self._insert_messages()
+        start = int(datetime(2021, 1, 11).timestamp() * 1000)
+        expected = {m[0] for i, m in enumerate(messages)
+                    if m[1] == '+15550000001' and m[2] >= start and m[3] == 1
+                    and (query == 'lunch' or i % 10 == 0)}
+
+        first, ids = self._search_all(
+            authenticated_client,
+            f'/api/search?q={query}&sort={sort}&phone=%2B15550000001&from=2021-01-11&type=1')
+
+        assert first['total'] == len(expected)
+        assert len(ids) == len(set(ids))
+        assert set(ids) == expected
+
+    @pytest.mark.parametrize('params', [
+        'phone=%2B15550000001',
+        'from=2021-01-11&to=2021-02-10',
+        'type=2',
+        'phone=%2B15550000003&type=1&to=2021-02-01',
+    ])
+    @pytest.mark.parametrize('query', ['lunch', 'dinner'])
+    @pytest.mark.parametrize('sort', ['date', 'relevance', 'hybrid'])
+    def test_filters_never_scan_messages(self, authenticated_client, temp_db, monkeypatch,
+                                         params, query, sort):
+        """Test that every statement a filtered search runs reads messages through an index."""
+        self._insert_messages()
+        statements = []
+        open_connection = db_module.ConnectionPool.open
+
+        def open_traced(pool):
+            conn = open_connection(pool)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        monkeypatch.setattr(db_module.ConnectionPool, 'open', open_traced)
+        response = authenticated_client.get(
+            f'/api/search?q={query}&sort={sort}&count=exact&{params}')
+        assert response.status_code == 200
+
+        conn = db_module.get_connection()
+        details = [row['detail'] for sql in statements if sql.lstrip().startswith('SELECT')
+                   for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+        conn.close()
+
+        assert any('idx_messages_' in detail for detail in details)
+        assert not [detail for detail in details if re.match(r'SCAN (m|messages)\b', detail)]
+
+    def test_prefer_index(self, temp_db, monkeypatch):
+        """Test that the plan follows whichever side selects fewer messages."""
+        monkeypatch.setattr(app_module, 'SEARCH_PLAN_SAMPLE', 10)
+        self._insert_messages()
+        one_contact = app_module.search_filters({'phone': '+15550000001'})
+        one_day = app_module.search_filters({'from': '2021-01-01', 'to': '2021-01-01'})
+
+        with db_module.connection() as conn:
+            cursor = conn.cursor()
+            common_and_narrow = app_module.prefer_index(cursor, '"lunch"', *one_day, 50)
+            rare_and_broad = app_module.prefer_index(cursor, '"dinner"', *one_contact, 50)
+
+        assert common_and_narrow is True
+        assert rare_and_broad is False
+
+    def _cluster_in_oldest(self, messages, count):
+        """Add 'zebrafish' to the oldest `count` of `messages`."""
+        conn = db_module.get_connection()
+        conn.executemany("UPDATE messages SET body = body || ' zebrafish' WHERE id = ?",
+                         [(m[0],) for m in messages[:count]])
+        conn.commit()
+        conn.close()
+
+    def test_prefer_index_when_both_sides_are_common(self, temp_db, monkeypatch):
+        """Test that the walk is weighed against matches clustered away from its start."""
+        monkeypatch.setattr(app_module, 'SEARCH_PLAN_SAMPLE', 10)
+        self._cluster_in_oldest(self._insert_messages(), 15)
+        everything = app_module.search_filters({'from': '2021-01-01'})
+
+        with db_module.connection() as conn:
+            cursor = conn.cursor()
+            spread = app_module.prefer_index(cursor, '"lunch"', *everything, 5)
+            clustered = app_module.prefer_index(cursor, '"zebrafish"', *everything, 5)
+            ranked = app_module.prefer_index(cursor, '"zebrafish"', *everything)
+
+        assert spread is True
+        assert clustered is False
+        assert ranked is False
+
+    def test_unfiltered_search_joins_old_matches(self, authenticated_client, temp_db,
+                                                 monkeypatch):
+        """Test that a search without filters never walks the timestamp index."""
+        monkeypatch.setattr(app_module, 'SEARCH_PLAN_SAMPLE', 10)
+        messages = self._insert_messages()
+        self._cluster_in_oldest(messages, 15)
+        statements = []
+        open_connection = db_module.ConnectionPool.open
+
+        def open_traced(pool):
+            conn = open_connection(pool)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        monkeypatch.setattr(db_module.ConnectionPool, 'open', open_traced)
+        data = authenticated_client.get('/api/search?q=zebrafish').get_json()
+
+        assert [r['id'] for r in data['results']] == [m[0] for m in messages[14::-1]]
+        assert not [sql for sql in statements if 'idx_messages_timestamp' in sql]
+
+    def test_filters_split_the_cache(self, authenticated_client, temp_db):
+        """Test that a filtered search is not answered from an unfiltered one."""
+        self._insert_messages()
+
+        everyone = authenticated_client.get('/api/search?q=lunch').get_json()
+        one_contact = authenticated_client.get('/api/search?q=lunch&phone=%2B15550000001').get_json()
+
+        assert everyone['total'] == 60
+        assert one_contact['total'] == 20
+
+    @pytest.mark.parametrize('params', ['from=2021-13-01', 'to=yesterday', 'type=sent',
+                                        'from=0001-01-01', 'to=9999-12-31',
+                                        'type=99999999999999999999'])
+    def test_invalid_filter(self, authenticated_client, sample_messages, params):
+        """Test that malformed filters are rejected."""
+        response = authenticated_client.get(f'/api/search?q=party&{params}')
+
+        assert response.status_code == 400
+        assert response.get_json()['error'].split()[0] == params.split('=')[0]
+
+
+class TestMessageAPI:
+    """Tests for the /api/messages/<id> endpoint."""
+
+    def test_returns_full_body(self, authenticated_client, sample_messages):
+        """Test that the whole message is returned, HTML-escaped."""
+        data = authenticated_client.get('/api/messages/2').get_json()
+
+        assert data['id'] == 2
+        assert data['body'] == 'Don&#x27;t forget to bring the groceries!'
+        assert data['truncated'] is False
+        assert data['formatted_date']
+
+    def test_highlights_query(self, authenticated_client, sample_messages):
+        """Test that q= highlights the matches like a search result."""
+        data = authenticated_client.get('/api/messages/2?q=grocery').get_json()
+
+        assert data['body'] == 'Don&#x27;t forget to bring the <mark>groceries</mark>!'
+
+    def test_query_not_in_message(self, authenticated_client, sample_messages):
+        """Test that a q= the message does not match leaves it plain."""
+        data = authenticated_client.get('/api/messages/2?q=party').get_json()
+
+        assert '<mark>' not in data['body']
+
+    def test_unknown_message(self, authenticated_client, sample_messages):
+        """Test that a missing id is a 404."""
+        response = authenticated_client.get('/api/messages/999')
+
+        assert response.status_code == 404
+        assert response.get_json()['error'] == 'Message not found'
+
+
+class TestConversationAPI:
+    """Tests for the /api/conversation/<phone> endpoint."""
+
+    PHONE = '+15550000001'
+
+    def _insert_thread(self, count):
+        """
+        Insert a `count` message thread with PHONE, in timestamp ties of
+        two, interleaved with messages from another number. Return the
+        thread's ids, oldest first.
+        """
+        conn = db_module.get_connection()
+        ids = []
+        for i in range(count):
+            for phone in (self.PHONE, '+15550000002'):
+                cursor = conn.execute('''
+                    INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (phone, f'message {i}', 1700000000000 + i // 2, i % 2 + 1,
+                      (2 * i + (phone != self.PHONE)).to_bytes(16, 'big')))
+                if phone == self.PHONE:
+                    ids.append(cursor.lastrowid)
+        conn.commit()
+        conn.close()
+        return ids
+
+    def _get(self, client, query=''):
+        return client.get(f'/api/conversation/%2B15550000001?{query}')
+
+    def test_around_returns_both_sides(self, authenticated_client, temp_db):
+        """Test that the anchor comes with its older and newer messages, oldest first."""
+        ids = self._insert_thread(10)
+
+        data = self._get(authenticated_client, f'around={ids[5]}&before=3&after=2').get_json()
+
+        assert [m['id'] for m in data['messages']] == ids[2:8]
+        assert {m['phone_number'] for m in data['messages']} == {self.PHONE}
+        assert data['has_before'] is True
+        assert data['has_after'] is True
+
+    def test_ends_of_thread(self, authenticated_client, temp_db):
+        """Test that has_before and has_after are false at the ends."""
+        ids = self._insert_thread(10)
+
+        first = self._get(authenticated_client, f'around={ids[0]}&before=5&after=9').get_json()
+        last = self._get(authenticated_client, f'around={ids[-1]}&before=9&after=5').get_json()
+
+        assert [m['id'] for m in first['messages']] == ids
+        assert first['has_before'] is False and first['has_after'] is False
+        assert [m['id'] for m in last['messages']] == ids
+        assert last['has_before'] is False and last['has_after'] is False
+
+    def test_without_around_returns_newest(self, authenticated_client, temp_db):
+        """Test that the thread opens at its newest messages."""
+        ids = self._insert_thread(10)
+
+        data = self._get(authenticated_client, 'before=4').get_json()
+
+        assert [m['id'] for m in data['messages']] == ids[-4:]
+        assert data['has_before'] is True
+        assert data['has_after'] is False
+
+    def test_scrolling_visits_every_message_once(self, authenticated_client, temp_db):
+        """Test that scrolling on from the first and last messages walks the whole thread."""
+        ids = self._insert_thread(25)
+        data = self._get(authenticated_client, f'around={ids[12]}&before=2&after=2').get_json()
+        seen = [m['id'] for m in data['messages']]
+
+        has_before, has_after = data['has_before'], data['has_after']
+        while has_before:
+            data = self._get(authenticated_client, f'around={seen[0]}&before=4&after=0').get_json()
+            seen = [m['id'] for m in data['messages'][:-1]] + seen
+            has_before = data['has_before']
+        while has_after:
+            data = self._get(authenticated_client, f'around={seen[-1]}&before=0&after=4').get_json()
+            seen += [m['id'] for m in data['messages'][1:]]
+            has_after = data['has_after']
+
+        assert seen == ids
+
+    def test_cost_does_not_grow_with_thread(self, authenticated_client, temp_db, monkeypatch):
+        """Test that a page of a long thread takes no more SQLite work than a short one."""
+        steps = []
+        open_connection = db_module.ConnectionPool.open
+
+        def open_counted(pool):
+            conn = open_connection(pool)
+            conn.set_progress_handler(lambda: steps.append(1), 1)
+            return conn
+
+        monkeypatch.setattr(db_module.ConnectionPool, 'open', open_counted)
+        short = self._insert_thread(20)
+        conn = db_module.get_connection()
+        cursor = conn.executemany('''
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15550000009', 'message', ?, 1, ?)
+        ''', [(1700000000000 + i, (10_000 + i).to_bytes(16, 'big')) for i in range(2000)])
+        long_middle = conn.execute('''
+            SELECT id FROM messages WHERE phone_number = '+15550000009' ORDER BY id LIMIT 1 OFFSET 1000
+        ''').fetchone()['id']
+        conn.commit()
+        conn.close()
+
+        def cost(phone, message_id):
+            steps.clear()
+            response = authenticated_client.get(
+                f'/api/conversation/{phone}?around={message_id}&before=5&after=5')
+            assert len(response.get_json()['messages']) == 11
+            return len(steps)
+
+        # The first request also reads the schema
+        cost('%2B15550000001', short[10])
+        assert cost('%2B15550000009', long_middle) <= cost('%2B15550000001', short[10])
+
+    def test_message_from_another_thread(self, authenticated_client, sample_messages):
+        """Test that the anchor must belong to the conversation."""
+        response = authenticated_client.get('/api/conversation/%2B15559876543?around=1')
+
+        assert response.status_code == 404
+        assert response.get_json()['error'] == 'Message not found'
+
+    @pytest.mark.parametrize('query', ['before=101', 'after=-1', 'before=x', 'around=abc'])
+    def test_invalid_parameters(self, authenticated_client, sample_messages, query):
+        """Test that malformed counts and anchors are rejected."""
+        response = authenticated_client.get(f'/api/conversation/%2B15551234567?{query}')
+
+        assert response.status_code == 400
+
+
+class TestSuggestAPI:
+    """Tests for the /api/suggest typeahead endpoint."""
+
+    def test_completes_last_word(self, authenticated_client, sample_messages):
+        """Test that completions are whole words, not porter stems."""
+        data = authenticated_client.get('/api/suggest?q=bi').get_json()
+
+        assert data['terms'] == ['birthday']
+        assert data['messages'][0]['body'].startswith('Happy <mark>birthday</mark>')
+
+    def test_earlier_words_narrow_messages(self, authenticated_client, sample_messages):
+        """Test that complete words and the prefix must all match."""
+        data = authenticated_client.get('/api/suggest?q=the we').get_json()
+
+        assert data['terms'] == ['weather']
+        assert [m['id'] for m in data['messages']] == [5]
+
+    def test_newest_messages_first(self, authenticated_client, sample_messages):
+        """Test that the preview lists the most recent matches first."""
+        data = authenticated_client.get('/api/suggest?q=to').get_json()
+
+        assert [m['id'] for m in data['messages']] == [5, 4, 2]
+
+    def test_finished_word_is_not_completed(self, authenticated_client, sample_messages):
+        """Test that a trailing space ends the last word."""
+        data = authenticated_client.get('/api/suggest?q=happy ').get_json()
+
+        assert data['terms'] == []
+        assert [m['id'] for m in data['messages']] == [3]
+
+    def test_short_prefix_is_ignored(self, authenticated_client, sample_messages):
+        """Test that one character is too short to complete."""
+        data = authenticated_client.get('/api/suggest?q=b').get_json()
+
+        assert data == {'terms': [], 'messages': []}
+
+    @pytest.mark.parametrize('word', ['happy', 'birthday'])
+    def test_complete_word_is_offered(self, authenticated_client, sample_messages, word):
+        """Test that a whole word is offered though its stem is spelled differently."""
+        data = authenticated_client.get(f'/api/suggest?q={word}').get_json()
+
+        assert data['terms'] == [word]
+
+    def test_word_longer_than_its_stem(self, authenticated_client, temp_db):
+        """Test that words are completed past the end of their stem."""
+        conn = db_module.get_connection()
+        conn.executemany('''
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', ?, ?, 1, ?)
+        ''', [('Running late', 1700000000000, b'\x01'),
+              ('Went for a run', 1700000001000, b'\x02')])
+        conn.commit()
+        conn.close()
+
+        for prefix in ('runn', 'running'):
+            data = authenticated_client.get(f'/api/suggest?q={prefix}').get_json()
+            assert data['terms'] == ['running']
+        assert authenticated_client.get('/api/suggest?q=ru').get_json()['terms'] == ['run']
+
+    def test_diacritics_and_case(self, authenticated_client, temp_db):
+        """Test that the prefix is folded like the tokenizer folds the index."""
+        conn = db_module.get_connection()
+        conn.execute('''
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', 'Meet at the Café', 1700000000000, 1, x'01')
+        ''')
+        conn.commit()
+        conn.close()
+
+        data = authenticated_client.get('/api/suggest?q=CAF').get_json()
+
+        assert data['terms'] == ['café']
+
+
+class TestSearchCache:
+    """Tests for the /api/search result cache."""
+
+    def _cache_stats(self, client):
+        return client.get('/api/stats').get_json()['search_cache']
+
+    def test_repeated_search_is_a_hit(self, authenticated_client, sample_messages):
+        """Test that the same search is answered from the cache."""
+        before = self._cache_stats(authenticated_client)
+        first = authenticated_client.get('/api/search?q=party').get_json()
+        second = authenticated_client.get('/api/search?q=Party ').get_json()
+        after = self._cache_stats(authenticated_client)
+
+        assert first == second
+        assert after['misses'] - before['misses'] == 1
+        assert after['hits'] - before['hits'] == 1
+
+    def test_commit_invalidates(self, authenticated_client, sample_messages):
+        """Test that a commit from another connection is never hidden."""
+        first = authenticated_client.get('/api/search?q=party').get_json()
+
+        conn = db_module.get_connection()
+        conn.execute('''
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15550000000', 'Another party', 1800000000000, 1, x'01')
+        ''')
+        conn.commit()
+        conn.close()
+        second = authenticated_client.get('/api/search?q=party').get_json()
+
+        assert first['total'] == 1
+        assert second['total'] == 2
+        assert self._cache_stats(authenticated_client)['entries'] == 1
+
+    def test_least_recently_used_is_evicted(self, authenticated_client, sample_messages,
+                                             monkeypatch):
+        """Test that the cache holds at most `size` responses."""
+        monkeypatch.setattr(app_module.search_cache, 'size', 2)
+        for query in ('party', 'birthday', 'party', 'meeting'):
+            authenticated_client.get(f'/api/search?q={query}')
+
+        before = self._cache_stats(authenticated_client)
+        authenticated_client.get('/api/search?q=party')
+        authenticated_client.get('/api/search?q=birthday')
+        after = self._cache_stats(authenticated_client)
+
+        assert after['entries'] == 2
+        assert after['hits'] - before['hits'] == 1
+        assert after['misses'] - before['misses'] == 1
+
+    def test_errors_are_not_cached(self, authenticated_client, sample_messages):
+        """Test that rejected requests never reach the cache."""
+        before = self._cache_stats(authenticated_client)
+        authenticated_client.get('/api/search?q=party&cursor=garbage!')
+        after = self._cache_stats(authenticated_client)
+
+        assert after['misses'] == before['misses']
+        assert after['entries'] == before['entries']
+
+
+def big_backup(count):
+    """Return backup XML bytes with `count` distinct messages."""
+    rows = ''.join(
+        f'<sms address="+15551234567" body="message {i}" date="{1700000000000 + i}" type="1" />\n'
+        for i in range(count)
+    )
+    return f'<smses count="{count}">\n{rows}</smses>\n'.encode()
+
+
+class TestImportAPI:
+    """Tests for background imports and their progress events."""
+
+    @pytest.fixture(autouse=True)
+    def fast_events(self, monkeypatch):
+        monkeypatch.setattr(app_module, 'IMPORT_EVENTS_INTERVAL', 0.01)
+
+    def _wait(self):
+        # The worker releases the lock when the import has finished
+        assert app_module.import_lock.acquire(timeout=10)
+        app_module.import_lock.release()
+
+    def _upload(self, client, data, **params):
+        query = '&'.join(f'{key}={value}' for key, value in params.items())
+        return client.post(f'/api/imports?{query}', data=data,
+                           content_type='application/octet-stream')
+
+    def test_upload_imports_backup(self, authenticated_client, sample_xml_file):
+        """Test that an uploaded backup is imported in the background."""
+        with open(sample_xml_file, 'rb') as f:
+            response = self._upload(authenticated_client, f.read(), name='backup.xml')
+
+        assert response.status_code == 202
+        job = json.loads(response.data)
+        assert job['file_name'] == 'backup.xml'
+        assert job['events_url'] == f"/api/imports/{job['id']}/events"
+        self._wait()
+
+        job = json.loads(authenticated_client.get(f"/api/imports/{job['id']}").data)
+        assert job['status'] == 'completed'
+        assert job['processed_messages'] == 3
+        data = json.loads(authenticated_client.get('/api/search?q=testing').data)
+        assert data['total'] == 1
+
+    def test_upload_compressed_backup(self, authenticated_client):
+        """Test that a gzip upload is decompressed while it streams in."""
+        response = self._upload(authenticated_client, gzip.compress(big_backup(2500)),
+                                source='pixel')
+        self._wait()
+
+        job = json.loads(authenticated_client.get(f"/api/imports/{json.loads(response.data)['id']}").data)
+        assert job['status'] == 'completed'
+        assert job['source'] == 'pixel'
+        assert json.loads(authenticated_client.get('/api/stats').data)['message_count'] == 2500
+
+    def test_invalid_upload_fails_job(self, authenticated_client):
+        """Test that a malformed backup marks the job failed."""
+        response = self._upload(authenticated_client, b'<smses><sms address=')
+        self._wait()
+
+        job = json.loads(authenticated_client.get(f"/api/imports/{json.loads(response.data)['id']}").data)
+        assert job['status'] == 'failed'
+        assert job['error_message']
+
+    def test_setup_failure_fails_job(self, authenticated_client, monkeypatch):
+        """Test that an import failing before it starts still ends its job and event stream."""
+        def locked():
+            raise sqlite3.OperationalError('database is locked')
+
+        monkeypatch.setattr(db_module, 'init_db', locked)
+        response = self._upload(authenticated_client, big_backup(10))
+        self._wait()
+
+        job_id = json.loads(response.data)['id']
+        job = json.loads(authenticated_client.get(f'/api/imports/{job_id}').data)
+        assert job['status'] == 'failed'
+        assert job['error_message'] == 'database is locked'
+        body = authenticated_client.get(f'/api/imports/{job_id}/events').get_data(as_text=True)
+        assert body.strip().split('\n\n')[-1].startswith('event: done')
+
+    def test_unexpected_error_fails_job(self, authenticated_client, monkeypatch):
+        """Test that an exception escaping import_xml marks the job failed."""
+        def crash(*args, **kwargs):
+            raise RuntimeError('disk on fire')
+
+        monkeypatch.setattr(import_sms, 'import_xml', crash)
+        response = self._upload(authenticated_client, big_backup(10))
+        self._wait()
+
+        job = json.loads(authenticated_client.get(f"/api/imports/{json.loads(response.data)['id']}").data)
+        assert job['status'] == 'failed'
+        assert job['error_message'] == 'disk on fire'
+
+    def test_one_import_at_a_time(self, authenticated_client):
+        """Test that a second upload is refused while one is running."""
+        with app_module.import_lock:
+            response = self._upload(authenticated_client, b'<smses />')
+
+        assert response.status_code == 409
+
+    def test_multipart_upload_rejected(self, authenticated_client):
+        """Test that form uploads, which would be buffered, are refused."""
+        response = authenticated_client.post('/api/imports', data={'file': 'x'})
+
+        assert response.status_code == 415
+
+    def test_list_imports(self, authenticated_client, sample_xml_file):
+        """Test that recent imports are listed, including CLI imports."""
+        import_sms.import_xml(sample_xml_file)
+
+        data = json.loads(authenticated_client.get('/api/imports').data)
+
+        assert data['imports'][0]['file_name'] == sample_xml_file
+        assert data['imports'][0]['status'] == 'completed'
+
+    def test_events_stream_progress(self, authenticated_client):
+        """Test that progress events are sent until the job finishes."""
+        conn = db_module.get_connection()
+        job_id = import_sms.start_job(conn, 'backup.xml')
+        conn.close()
+
+        def progress():
+            conn = db_module.get_connection()
+            time.sleep(0.05)
+            import_sms.checkpoint_job(conn.cursor(), job_id, 1000, None, 2000, None)
+            conn.commit()
+            time.sleep(0.05)
+            import_sms.finish_job(conn, job_id, 'completed', 2000, 2000, None)
+            conn.close()
+
+        worker = threading.Thread(target=progress)
+        worker.start()
+        response = authenticated_client.get(f'/api/imports/{job_id}/events')
+        body = response.get_data(as_text=True)
+        worker.join()
+
+        assert response.mimetype == 'text/event-stream'
+        events = [block.split('\n') for block in body.strip().split('\n\n')]
+        names = [lines[0] for lines in events]
+        assert names[0] == 'event: progress'
+        assert names[-1] == 'event: done'
+        processed = [json.loads(lines[1][len('data: '):])['processed_messages']
+                     for lines in events]
+        assert 1000 in processed
+        assert json.loads(events[-1][1][len('data: '):])['status'] == 'completed'
+
+    def test_events_unknown_job(self, authenticated_client):
+        """Test that events for a missing job return 404."""
+        response = authenticated_client.get('/api/imports/999/events')
+
+        assert response.status_code == 404
+
+    def test_search_during_import(self, authenticated_client, sample_messages):
+        """Test that searches are served while an upload is being imported."""
+        data = big_backup(2500)
+        split = data.index(b'message 1500')
+        resume = threading.Event()
+
+        class SlowUpload(io.BytesIO):
+            """Request body that stalls partway, like a slow client."""
+
+            def read(self, size=-1):
+                position = self.tell()
+                if position < split:
+                    return super().read(min(size if size >= 0 else split, split - position))
+                resume.wait(10)
+                return super().read(size)
+
+        uploader = threading.Thread(target=lambda: authenticated_client.post(
+            '/api/imports', input_stream=SlowUpload(data),
+            content_type='application/octet-stream'))
+        uploader.start()
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                jobs = json.loads(authenticated_client.get('/api/imports').data)['imports']
+                if jobs and jobs[0]['processed_messages'] >= 1000:
+                    break
+                time.sleep(0.01)
+
+            response = authenticated_client.get('/api/search?q=message')
+            assert response.status_code == 200
+            assert json.loads(response.data)['total'] >= 1000
+            assert jobs[0]['status'] == 'running'
+        finally:
+            resume.set()
+            uploader.join()
+        self._wait()
+
+        assert json.loads(authenticated_client.get('/api/stats').data)['message_count'] == 2505
+
 
 class TestSecurityHeaders:
     """Tests for security headers."""
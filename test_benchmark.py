@@ -0,0 +1,128 @@
+"""Tests for the benchmark suite."""
+
+import subprocess
+
+import pytest
+
+import benchmark
+import db as db_module
+import import_sms
+
+
+class TestGenerateBackup:
+    """Tests for the synthetic backup generator."""
+
+    def test_generates_requested_messages(self, tmp_path):
+        """Test that the file holds the requested number of messages."""
+        path = tmp_path / 'bench.xml'
+
+        distinct = benchmark.generate_backup(path, 500, duplicate_ratio=0.2, seed=1)
+        data = path.read_text(encoding='utf-8')
+
+        assert data.count('<sms ') == 500
+        assert '<smses count="500"' in data
+        assert 300 < distinct < 500
+
+    def test_same_seed_same_file(self, tmp_path):
+        """Test that generation is reproducible."""
+        benchmark.generate_backup(tmp_path / 'a.xml', 200, seed=7)
+        benchmark.generate_backup(tmp_path / 'b.xml', 200, seed=7)
+
+        assert (tmp_path / 'a.xml').read_bytes() == (tmp_path / 'b.xml').read_bytes()
+
+    def test_repeated_mms_are_verbatim(self, tmp_path):
+        """Test that an MMS rebuilt for the duplicate window matches the original."""
+        path = tmp_path / 'bench.xml'
+
+        distinct = benchmark.generate_backup(path, 200, duplicate_ratio=0.3,
+                                             mms_ratio=1, attachment_kb=1, seed=3)
+        data = path.read_text(encoding='utf-8').removesuffix('</smses>\n')
+        elements = data.split('  <mms ')[1:]
+
+        assert len(elements) == 200
+        assert len(set(elements)) == distinct < 200
+
+    def test_body_length_is_capped(self, tmp_path):
+        """Test that bodies respect --body-max."""
+        path = tmp_path / 'bench.xml'
+        benchmark.generate_backup(path, 200, body_median=500, body_max=50)
+
+        with open(path, 'rb') as f:
+            records = [record for chunk, offset in
+                       import_sms.iter_sms_chunks(f, lambda attrs: None) for record in chunk]
+
+        assert len(records) == 200
+        assert max(len(record[2]) for record in records) <= 50
+
+    def test_import_counts_duplicates(self, tmp_path, monkeypatch):
+        """Test that the importer sees exactly the generated duplicates."""
+        monkeypatch.setattr(db_module, 'DB_PATH', str(tmp_path / 'messages.db'))
+        path = tmp_path / 'bench.xml.gz'
+        distinct = benchmark.generate_backup(path, 1000, duplicate_ratio=0.1,
+                                             mms_ratio=0.01, attachment_kb=1)
+
+        imported, duplicates, error = import_sms.import_xml(str(path))
+
+        assert error is None
+        assert imported == distinct
+        assert duplicates == 1000 - distinct
+
+
+class TestRunBenchmark:
+    """Tests for the benchmark harness and its report."""
+
+    def test_report_has_metrics(self, tmp_path):
+        """Test that a run reports throughput, memory and sizes per phase."""
+        path = tmp_path / 'bench.xml'
+        benchmark.generate_backup(path, 300)
+
+        report = benchmark.run_benchmark(path, repeat=1, reimport=True)
+
+        assert report['parser'] == 'expat'
+        assert [run['phase'] for run in report['runs']] == ['import', 'reimport']
+        first = report['summary']['import']
+        assert first['imported'] == 300
+        assert first['messages_per_second'] > 0
+        assert first['db_bytes'] > 0
+        assert report['summary']['reimport']['duplicates'] == 300
+
+    def test_relative_backup_path(self, tmp_path, monkeypatch):
+        """Test that a backup path relative to the caller's directory is found."""
+        benchmark.generate_backup(tmp_path / 'bench.xml', 50)
+        monkeypatch.chdir(tmp_path)
+
+        report = benchmark.run_benchmark('bench.xml', repeat=1)
+
+        assert report['summary']['import']['imported'] == 50
+
+    def test_child_error_is_shown(self, tmp_path, capsys):
+        """Test that a failed run prints the child's error output."""
+        path = tmp_path / 'bench.xml'
+        path.write_text('<smses><sms')
+
+        with pytest.raises(subprocess.CalledProcessError):
+            benchmark.run_benchmark(path, repeat=1)
+
+        assert 'Traceback' in capsys.readouterr().err
+
+    def _report(self, rate, rss):
+        return {'summary': {'import': {
+            'messages_per_second': rate, 'peak_rss_mb': rss,
+            'db_bytes': 1000, 'fts_bytes': None,
+        }}}
+
+    def test_baseline_within_tolerance(self):
+        """Test that small differences are not regressions."""
+        regressions = benchmark.compare_to_baseline(
+            self._report(95_000, 40.0), self._report(100_000, 38.0), tolerance=0.1)
+
+        assert regressions == []
+
+    def test_baseline_regressions(self):
+        """Test that slower imports and higher memory are reported."""
+        regressions = benchmark.compare_to_baseline(
+            self._report(80_000, 60.0), self._report(100_000, 40.0), tolerance=0.1)
+
+        assert len(regressions) == 2
+        assert regressions[0].startswith('import: 80,000 msg/s')
+        assert 'peak_rss_mb' in regressions[1]
@@ -1,6 +1,14 @@
 """Tests for database module."""
 
+import hashlib
+import os
+import sqlite3
+import threading
+
+import pytest
+
 import db as db_module
+import import_sms
 
 
 class TestDatabaseInit:
@@ -132,3 +140,376 @@ class TestFTSSync:
         conn.close()
 
         assert result is None
+
+
+class TestBulkLoad:
+    """Tests for deferred FTS indexing during bulk loads."""
+
+    def _insert(self, cursor, body, import_hash):
+        cursor.execute('''
+            INSERT INTO messages (phone_number, contact_name, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', 'Test', ?, 1700000000000, 1, ?)
+        ''', (body, import_hash))
+
+    def _triggers(self, cursor):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger'")
+        return {row['name'] for row in cursor.fetchall()}
+
+    def test_begin_bulk_load_suspends_triggers(self, temp_db):
+        """Test that rows loaded in bulk mode are not indexed per row."""
+        db_module.DB_PATH = temp_db
+        conn = db_module.get_connection()
+        cursor = conn.cursor()
+
+        db_module.begin_bulk_load(conn)
+        self._insert(cursor, 'bulk content qwe456', 'bulkhash')
+        conn.commit()
+
+        assert self._triggers(cursor) == set()
+        cursor.execute("SELECT * FROM messages_fts WHERE messages_fts MATCH 'qwe456'")
+        assert cursor.fetchone() is None
+        conn.close()
+
+    def test_end_bulk_load_indexes_new_rows(self, temp_db):
+        """Test that ending a bulk load indexes only the loaded range."""
+        db_module.DB_PATH = temp_db
+        conn = db_module.get_connection()
+        cursor = conn.cursor()
+
+        self._insert(cursor, 'existing content asd111', 'existinghash')
+        conn.commit()
+
+        db_module.begin_bulk_load(conn)
+        self._insert(cursor, 'bulk content qwe456', 'bulkhash')
+        conn.commit()
+        db_module.end_bulk_load(conn)
+
+        assert self._triggers(cursor) == {'messages_ai', 'messages_ad', 'messages_au'}
+        cursor.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'qwe456 OR asd111'")
+        assert len(cursor.fetchall()) == 2
+        cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES('integrity-check')")
+        cursor.execute("SELECT value FROM meta WHERE key = 'fts_pending_from'")
+        assert cursor.fetchone() is None
+        conn.close()
+
+    def test_init_db_recovers_interrupted_bulk_load(self, temp_db):
+        """Test that init_db indexes rows from a bulk load that never ended."""
+        db_module.DB_PATH = temp_db
+        conn = db_module.get_connection()
+        cursor = conn.cursor()
+
+        db_module.begin_bulk_load(conn)
+        self._insert(cursor, 'orphaned content zxc789', 'orphanhash')
+        conn.commit()
+        conn.close()
+
+        db_module.init_db()
+
+        conn = db_module.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM messages_fts WHERE messages_fts MATCH 'zxc789'")
+        assert cursor.fetchone() is not None
+        assert 'messages_ai' in self._triggers(cursor)
+        conn.close()
+
+
+class TestMigrations:
+    """Tests for upgrading databases created by older versions."""
+
+    def _create_legacy_db(self, path):
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+            CREATE TABLE messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                phone_number TEXT NOT NULL,
+                contact_name TEXT,
+                body TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                message_type INTEGER NOT NULL,
+                import_hash TEXT UNIQUE
+            );
+            CREATE INDEX idx_messages_timestamp ON messages(timestamp DESC);
+            CREATE INDEX idx_messages_import_hash ON messages(import_hash);
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                body, content='messages', content_rowid='id', tokenize='porter unicode61'
+            );
+            CREATE TRIGGER messages_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, body) VALUES (new.id, new.body);
+            END;
+        ''')
+        legacy_hash = hashlib.sha256(b'1700000000000+15551234567Legacy message').hexdigest()
+        conn.execute('''
+            INSERT INTO messages (phone_number, contact_name, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', 'Test', 'Legacy message', 1700000000000, 1, ?)
+        ''', (legacy_hash,))
+        conn.commit()
+        conn.close()
+
+    def test_migrate_converts_import_hash_to_blob(self, tmp_path):
+        """Test that legacy hex hashes become compact binary digests."""
+        path = str(tmp_path / 'legacy.db')
+        self._create_legacy_db(path)
+        original_path = db_module.DB_PATH
+        db_module.DB_PATH = path
+        try:
+            db_module.init_db()
+
+            conn = db_module.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA table_info(messages)")
+            types = {row['name']: row['type'] for row in cursor.fetchall()}
+            cursor.execute("SELECT import_hash FROM messages")
+            stored = cursor.fetchone()['import_hash']
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='messages'")
+            indexes = {row['name'] for row in cursor.fetchall()}
+            cursor.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'legacy'")
+            fts_rows = cursor.fetchall()
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()[0]
+            conn.close()
+        finally:
+            db_module.DB_PATH = original_path
+
+        assert types['import_hash'] == 'BLOB'
+        assert stored == import_sms.compute_import_hash(1700000000000, '+15551234567', 'Legacy message')
+        assert 'idx_messages_import_hash' not in indexes
+        assert {'idx_messages_timestamp', 'idx_messages_phone_timestamp',
+                'idx_messages_type_timestamp'} <= indexes
+        assert len(fts_rows) == 1
+        assert version == db_module.SCHEMA_VERSION
+
+    def test_migrate_adds_prefix_indexes(self, temp_db):
+        """Test that a version 4 index is rebuilt with prefix indexes."""
+        conn = db_module.get_connection()
+        conn.executescript('''
+            DROP TABLE messages_fts;
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                body, content='messages', content_rowid='id', tokenize='porter unicode61'
+            );
+            INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash)
+            VALUES ('+15551234567', 'Pizza tonight?', 1700000000000, 1, x'01');
+            INSERT INTO meta (key, value) VALUES ('fts_pending_from', 0);
+            PRAGMA user_version = 4;
+        ''')
+        conn.close()
+
+        db_module.init_db()
+
+        conn = db_module.get_connection()
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'").fetchone()[0]
+        matches = conn.execute(
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'piz*'").fetchall()
+        terms = conn.execute("SELECT term, doc FROM messages_vocab").fetchall()
+        conn.close()
+
+        assert "prefix='2 3'" in sql
+        assert len(matches) == 1
+        assert [tuple(row) for row in terms] == [('pizza', 1), ('tonight', 1)]
+
+    def test_new_database_has_single_hash_index(self, temp_db):
+        """Test that a fresh database only has the UNIQUE index on import_hash."""
+        db_module.DB_PATH = temp_db
+        conn = db_module.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT name FROM pragma_index_list('messages')")
+        indexes = {row['name'] for row in cursor.fetchall()}
+        conn.close()
+
+        assert 'idx_messages_import_hash' not in indexes
+        assert len([name for name in indexes if name.startswith('sqlite_autoindex')]) == 1
+
+
+class TestConnectionPool:
+    """Tests for the pooled connections used by the web app."""
+
+    def test_connection_is_reused(self, temp_db):
+        """Test that a returned connection is handed out again."""
+        with db_module.connection() as first:
+            pass
+        with db_module.connection() as second:
+            assert second is first
+            assert second.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 0
+
+    def test_nested_borrows_get_distinct_connections(self, temp_db):
+        """Test that a connection is never shared while borrowed."""
+        with db_module.connection() as first, db_module.connection() as second:
+            assert first is not second
+
+    def test_idle_connections_are_capped(self, temp_db, monkeypatch):
+        """Test that the pool keeps at most POOL_SIZE idle connections."""
+        pool = db_module.get_pool()
+        monkeypatch.setattr(pool, 'size', 2)
+        conns = [pool.acquire() for _ in range(4)]
+        for conn in conns:
+            pool.release(conn)
+
+        assert pool.idle == conns[:2]
+
+    def test_open_transaction_is_rolled_back(self, temp_db):
+        """Test that a transaction left open does not reach the next borrower."""
+        with db_module.connection() as conn:
+            conn.execute('BEGIN')
+            conn.execute('SELECT COUNT(*) FROM meta').fetchone()
+        with db_module.connection() as conn:
+            assert not conn.in_transaction
+
+    def test_broken_connection_is_replaced(self, temp_db):
+        """Test that a connection that fails the health check is dropped."""
+        with db_module.connection() as conn:
+            conn.close()
+        with db_module.connection() as fresh:
+            assert fresh is not conn
+            assert fresh.execute('SELECT 1').fetchone()[0] == 1
+
+    def test_pool_follows_db_path(self, temp_db, tmp_path):
+        """Test that changing DB_PATH retires the old pool."""
+        old = db_module.get_pool()
+        db_module.DB_PATH = str(tmp_path / 'other.db')
+
+        assert db_module.get_pool() is not old
+        assert db_module.get_pool().path == db_module.DB_PATH
+
+    def test_concurrent_borrowers(self, temp_db):
+        """Test that many threads can borrow and query at once."""
+        errors = []
+
+        def work():
+            try:
+                for _ in range(50):
+                    with db_module.connection() as conn:
+                        conn.execute('SELECT COUNT(*) FROM messages').fetchone()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert len(db_module.get_pool().idle) <= db_module.POOL_SIZE
+
+    def test_data_generation_follows_commits(self, temp_db):
+        """Test that the generation changes on commit and only then."""
+        first = db_module.data_generation()
+        assert db_module.data_generation() == first
+
+        conn = db_module.get_connection()
+        conn.execute("INSERT INTO meta (key, value) VALUES ('k', 'v')")
+        conn.commit()
+        conn.close()
+
+        assert db_module.data_generation() != first
+
+    def test_data_generation_follows_db_path(self, temp_db, tmp_path):
+        """Test that another database never shares a generation."""
+        first = db_module.data_generation()
+        db_module.DB_PATH = str(tmp_path / 'other.db')
+        db_module.init_db()
+
+        assert db_module.data_generation() != first
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork()')
+    def test_fork_gets_fresh_pool(self, temp_db):
+        """Test that a forked child does not reuse the parent's connections."""
+        with db_module.connection() as parent_conn:
+            pass
+
+        pid = os.fork()
+        if pid == 0:
+            with db_module.connection() as child_conn:
+                ok = child_conn is not parent_conn
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+
+        assert os.waitstatus_to_exitcode(status) == 0
+        with db_module.connection() as conn:
+            assert conn is parent_conn
+
+
+class TestWalMode:
+    """Tests for concurrent reads while an import writes."""
+
+    def test_init_db_enables_wal(self, temp_db):
+        """Test that the database is switched to write-ahead logging."""
+        conn = db_module.get_connection()
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        conn.close()
+
+    def test_unknown_journal_mode_rejected(self, temp_db, monkeypatch):
+        """Test that a typo in JOURNAL_MODE fails loudly."""
+        monkeypatch.setattr(db_module, 'JOURNAL_MODE', 'wall')
+
+        with pytest.raises(ValueError, match='JOURNAL_MODE'):
+            db_module.init_db()
+
+    def test_pooled_connections_are_read_only(self, temp_db):
+        """Test that web requests cannot take the write lock."""
+        with db_module.connection() as conn:
+            with pytest.raises(sqlite3.OperationalError, match='readonly'):
+                conn.execute("INSERT INTO meta (key, value) VALUES ('k', 'v')")
+
+    def test_reader_does_not_block_writer(self, temp_db):
+        """Test that a commit succeeds while a read transaction is open."""
+        with db_module.connection() as reader:
+            reader.execute('BEGIN')
+            assert reader.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 0
+
+            writer = sqlite3.connect(temp_db, timeout=0)
+            writer.execute("INSERT INTO messages (phone_number, body, timestamp, message_type, import_hash) "
+                           "VALUES ('+1', 'hi', 1, 1, x'00')")
+            writer.commit()
+            writer.close()
+
+            # The reader keeps its snapshot until its transaction ends
+            assert reader.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 0
+            reader.rollback()
+            assert reader.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 1
+
+    def test_import_truncates_wal(self, temp_db, sample_xml_file):
+        """Test that an import checkpoints and empties the -wal file."""
+        # An open reader, like the web app's pool, keeps the -wal file around
+        with db_module.connection() as conn:
+            conn.execute('SELECT COUNT(*) FROM messages').fetchone()
+            imported, _, error = import_sms.import_xml(sample_xml_file, quiet=True)
+
+            assert error is None
+            assert imported == 3
+            assert os.path.getsize(temp_db + '-wal') == 0
+
+    def test_search_during_import(self, temp_db, tmp_path):
+        """Test that searches keep succeeding while an import runs."""
+        import benchmark
+        path = tmp_path / 'bench.xml'
+        benchmark.generate_backup(path, 5000, seed=3)
+        result = {}
+        searches = []
+        errors = []
+
+        def run_import():
+            result['import'] = import_sms.import_xml(str(path), quiet=True)
+
+        def search():
+            while importer.is_alive():
+                try:
+                    with db_module.connection() as conn:
+                        conn.execute(
+                            'SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?',
+                            ('"pizza"',)).fetchone()
+                    searches.append(1)
+                except sqlite3.Error as e:
+                    errors.append(e)
+
+        importer = threading.Thread(target=run_import)
+        readers = [threading.Thread(target=search) for _ in range(4)]
+        importer.start()
+        for thread in readers:
+            thread.start()
+        for thread in readers + [importer]:
+            thread.join()
+
+        assert errors == []
+        assert searches
+        assert result['import'][2] is None